@@ -0,0 +1,155 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+from luckysheet_json import iter_sheets
+from main import MERGE_POLICIES, export_luckysheet_to_excel
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def glob_root(pattern):
+    # Directory part of a glob pattern before its first wildcard
+    parts = []
+    for part in os.path.dirname(pattern).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts)
+
+
+def find_inputs(patterns):
+    # {path: root}, root being the directory or glob root the path was found
+    # under; output_path keeps the path relative to it
+    paths = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found, root = sorted(glob.glob(os.path.join(pattern, "*.json"))), pattern
+        elif os.path.exists(pattern):
+            found, root = [pattern], os.path.dirname(pattern)
+        else:
+            found, root = sorted(glob.glob(pattern, recursive=True)), glob_root(pattern)
+        for path in found:
+            paths.setdefault(path, root)
+    return paths
+
+
+def output_path(input_path, output_dir, root=""):
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    if not output_dir:
+        return os.path.join(os.path.dirname(input_path), stem + ".xlsx")
+    folder = os.path.relpath(os.path.dirname(input_path) or os.curdir, root or os.curdir)
+    return os.path.normpath(os.path.join(output_dir, folder, stem + ".xlsx"))
+
+
+def peak_rss_mb():
+    # Peak RSS of this worker process; exact per file with one task per worker
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def count_cells(sheets, counter):
+    for sheet_data in sheets:
+        counter[0] += len(sheet_data.get("celldata", []))
+        yield sheet_data
+
+
+def convert_file(task):
+    input_path, output_file, options = task
+    counter = [0]
+    start = time.perf_counter()
+    try:
+        export_luckysheet_to_excel(count_cells(iter_sheets(input_path), counter), output_file, **options)
+        error = None
+    except Exception as exc:
+        error = "{0}: {1}".format(type(exc).__name__, exc)
+        if os.path.exists(output_file):
+            os.remove(output_file)
+    return {
+        "input": input_path,
+        "output": output_file,
+        "seconds": time.perf_counter() - start,
+        "cells": counter[0],
+        "peak_rss_mb": peak_rss_mb(),
+        "error": error,
+    }
+
+
+def format_result(result):
+    if result["error"]:
+        return "FAILED {0}: {1}".format(result["input"], result["error"])
+    peak = "-" if result["peak_rss_mb"] is None else "{0:.1f} MB".format(result["peak_rss_mb"])
+    return "{0} -> {1}  {2:.3f}s  {3} cells  peak {4}".format(
+        result["input"], result["output"], result["seconds"], result["cells"], peak)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Convert Luckysheet JSON files to xlsx in parallel.")
+    parser.add_argument("inputs", nargs="+", help="JSON files, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir",
+                        help="directory for the xlsx files, keeping the folders below each input directory or "
+                             "glob (default: next to each input)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument("--engine", choices=["openpyxl", "native"], default="openpyxl")
+    parser.add_argument("--write-only", action="store_true", help="use the write-only openpyxl mode")
+    parser.add_argument("--merge-policy", choices=MERGE_POLICIES, default="drop",
+                        help="how merges overlapping an earlier merge are handled")
+    parser.add_argument("--evaluate", action="store_true", help="recompute the cached values of formula cells")
+    parser.add_argument("--formulas", action="store_true",
+                        help="write formulas instead of their values with the openpyxl engine")
+    parser.add_argument("--tasks-per-worker", type=int, default=1,
+                        help="files converted by a worker before it is replaced (peak memory is per worker)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    inputs = find_inputs(args.inputs)
+    if not inputs:
+        print("No input files found", file=sys.stderr)
+        return 1
+    options = {"engine": args.engine, "write_only": args.write_only, "merge_policy": args.merge_policy,
+               "evaluate": args.evaluate, "formulas": args.formulas}
+    tasks = [(path, output_path(path, args.output_dir, root), options) for path, root in inputs.items()]
+
+    # Two inputs writing the same file would overwrite each other, possibly at the same time
+    sources = {}
+    for path, output_file, _ in tasks:
+        sources.setdefault(os.path.normcase(os.path.abspath(output_file)), []).append(path)
+    collisions = [paths for paths in sources.values() if len(paths) > 1]
+    if collisions:
+        for paths in collisions:
+            print("Same output file for {0}".format(", ".join(paths)), file=sys.stderr)
+        return 1
+    for _, output_file, _ in tasks:
+        os.makedirs(os.path.dirname(output_file) or os.curdir, exist_ok=True)
+
+    failed = 0
+    total_cells = 0
+    start = time.perf_counter()
+    with Pool(processes=args.jobs, maxtasksperchild=args.tasks_per_worker) as pool:
+        for result in pool.imap_unordered(convert_file, tasks):
+            print(format_result(result), flush=True)
+            if result["error"]:
+                failed += 1
+            else:
+                total_cells += result["cells"]
+    elapsed = time.perf_counter() - start
+
+    print("{0} files, {1} failed, {2} cells in {3:.2f}s ({4:.0f} cells/s)".format(
+        len(tasks), failed, total_cells, elapsed, total_cells / elapsed if elapsed else 0))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+import openpyxl
+
+from batch_export import peak_rss_mb
+from main import COLUMN_LETTERS, ExportStats, export_luckysheet_json, export_luckysheet_to_excel
+
+
+SCENARIOS = {
+    "default": {},
+    "multi_sheet": {"sheets": 10},
+    "text_heavy": {"string_ratio": 0.9},
+    "styled": {"style_diversity": 200, "border_density": 0.5},
+    "wide": {"columns": 300},
+    "merge_heavy": {"columns": 50, "merges": 5000},
+    "merge_banners": {"columns": 100, "merges": 20, "merge_size": 50},
+    "formula_heavy": {"columns": 20, "formula_columns": 10, "string_ratio": 0},
+    "rich_text": {"string_ratio": 0.9, "rich_ratio": 0.5},
+    # Compare the two to see what alignment costs
+    "unaligned": {"cells": 200000, "alignment": "none"},
+    "aligned": {"cells": 200000, "alignment": "full"},
+}
+
+ENGINES = {
+    "openpyxl": {},
+    "write_only": {"write_only": True},
+    "native": {"engine": "native"},
+}
+
+FONT_COLORS = ["rgb(51, 51, 51)", "rgb(255, 0, 0)", "rgb(0, 0, 255)", "#436eee", "#ffd700"]
+BACKGROUNDS = [None, None, None, "#1e90ff", "#00ff00", "rgb(255, 215, 0)"]
+WORDS = ["北京", "上海", "open", "closed", "pending", "Category A", "Category B", "total", "备注"]
+
+
+def generate_styles(rnd, count, alignment="basic"):
+    # alignment: "none", "basic" (ht / vt) or "full" (also wrap and rotation)
+    styles = []
+    for _ in range(max(count, 1)):
+        style = {
+            "bg": rnd.choice(BACKGROUNDS),
+            "bl": rnd.choice([0, 0, 1]),
+            "it": rnd.choice([0, 0, 1]),
+            "ff": rnd.randrange(0, 12),
+            "fs": rnd.choice([9, 10, 11, 12, 14, 16]),
+            "fc": rnd.choice(FONT_COLORS),
+            "ht": rnd.choice([0, 1, 2]),
+            "vt": rnd.choice([0, 1, 2]),
+        }
+        if alignment == "none":
+            del style["ht"], style["vt"]
+        elif alignment == "full":
+            style["tb"] = rnd.choice(["0", "1", "2"])
+            style["tr"] = rnd.choice(["0", "0", "0", "1", "2", "3", "4", "5"])
+        styles.append(style)
+    return styles
+
+
+def generate_sheet(rnd, name, cells, columns, styles, border_density, merges, merge_size, string_ratio,
+                   formula_columns, rich_ratio):
+    rows = max(cells // columns, 1)
+    celldata = []
+    for r in range(rows):
+        for c in range(columns):
+            if c >= max(columns - formula_columns, 2):
+                # Filled down the column: sums the two cells to the left
+                v = dict(rnd.choice(styles))
+                v.update({"v": 0, "m": "0", "ct": {"fa": "General", "t": "n"},
+                          "f": "={0}{2}+{1}{2}".format(COLUMN_LETTERS[c - 1], COLUMN_LETTERS[c], r + 1)})
+                celldata.append({"r": r, "c": c, "v": v})
+                continue
+            if rnd.random() < string_ratio:
+                value = "{0} {1}".format(rnd.choice(WORDS), rnd.randrange(100))
+                ct = {"fa": "@", "t": "s"}
+                if rnd.random() < rich_ratio:
+                    # Rich text: each word a run with its own font
+                    ct = {"fa": "General", "t": "inlineStr",
+                          "s": [dict(rnd.choice(styles), v=word + " ") for word in value.split(" ")]}
+            else:
+                value = round(rnd.uniform(-1000, 100000), 2)
+                ct = {"fa": "General", "t": "n"}
+            v = dict(rnd.choice(styles))
+            v.update({"v": value, "m": str(value), "ct": ct})
+            celldata.append({"r": r, "c": c, "v": v})
+
+    border_info = []
+    bordered = int(rows * columns * border_density)
+    while bordered > 0:
+        height = min(rnd.randrange(1, 50), rows)
+        width = min(rnd.randrange(1, 10), columns)
+        top = rnd.randrange(0, rows - height + 1)
+        left = rnd.randrange(0, columns - width + 1)
+        border_info.append({
+            "rangeType": "range",
+            "borderType": "border-all",
+            "style": str(rnd.randrange(1, 14)),
+            "color": rnd.choice(["#000000", "#ff0000", "#0000ff"]),
+            "range": [{"row": [top, top + height - 1], "column": [left, left + width - 1]}],
+        })
+        bordered -= height * width
+
+    # Merges are laid out on a grid so they never overlap
+    merge = {}
+    slots = [(r, c) for r in range(0, rows - merge_size + 1, merge_size)
+             for c in range(0, columns - merge_size + 1, merge_size)]
+    for r, c in rnd.sample(slots, min(merges, len(slots))):
+        rs = rnd.randrange(1, merge_size + 1)
+        cs = rnd.randrange(1, merge_size + 1)
+        if rs == 1 and cs == 1:
+            cs = 2
+        merge["{0}_{1}".format(r, c)] = {"r": r, "c": c, "rs": rs, "cs": cs}
+        celldata[r * columns + c]["v"]["mc"] = {"r": r, "c": c, "rs": rs, "cs": cs}
+        for rr in range(r, r + rs):
+            for cc in range(c, c + cs):
+                if (rr, cc) != (r, c):
+                    celldata[rr * columns + cc]["v"] = {"mc": {"r": r, "c": c}}
+
+    return {
+        "name": name,
+        "celldata": celldata,
+        "config": {
+            "merge": merge,
+            "borderInfo": border_info,
+            "columnlen": {str(c): rnd.randrange(60, 200) for c in range(columns) if rnd.random() < 0.5},
+            "rowlen": {str(r): rnd.choice([20, 20, 20, 30]) for r in range(rows) if rnd.random() < 0.2},
+        },
+    }
+
+
+def generate_workbook(cells=100000, sheets=1, columns=20, style_diversity=20, border_density=0.1, merges=10,
+                      merge_size=3, string_ratio=0.3, formula_columns=0, rich_ratio=0, alignment="basic", seed=0):
+    # Synthetic Luckysheet document with the same structure as the main.py sample
+    rnd = random.Random(seed)
+    styles = generate_styles(rnd, style_diversity, alignment)
+    per_sheet = max(cells // sheets, columns)
+    return [generate_sheet(rnd, "Sheet{0}".format(i + 1), per_sheet, columns, styles, border_density, merges,
+                           merge_size, string_ratio, formula_columns, rich_ratio)
+            for i in range(sheets)]
+
+
+def run_case(case):
+    scenario, params, engine, options, from_json = case
+    phases = {}
+
+    start = time.perf_counter()
+    data = generate_workbook(**params)
+    phases["generate"] = time.perf_counter() - start
+    cells = sum(len(sheet_data["celldata"]) for sheet_data in data)
+
+    stats = ExportStats()
+    options = dict(options, stats=stats)
+    with tempfile.TemporaryDirectory() as tmp:
+        output_file = os.path.join(tmp, "out.xlsx")
+        if from_json:
+            json_file = os.path.join(tmp, "in.json")
+            start = time.perf_counter()
+            with open(json_file, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            phases["serialize"] = time.perf_counter() - start
+            del data
+            start = time.perf_counter()
+            export_luckysheet_json(json_file, output_file, **options)
+        else:
+            start = time.perf_counter()
+            export_luckysheet_to_excel(data, output_file, **options)
+        phases["export"] = time.perf_counter() - start
+        output_bytes = os.path.getsize(output_file)
+
+    return {
+        "scenario": scenario,
+        "engine": engine,
+        "from_json": from_json,
+        "params": params,
+        "cells": cells,
+        "phases": phases,
+        "export_phases": stats.totals(),
+        "counts": stats.counts,
+        "dedup_ratio": stats.dedup_ratio(),
+        "cells_per_sec": cells / phases["export"] if phases["export"] else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "output_bytes": output_bytes,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark export_luckysheet_to_excel on synthetic documents.")
+    parser.add_argument("--scenario", nargs="+", choices=sorted(SCENARIOS), default=["default"])
+    parser.add_argument("--engine", nargs="+", choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument("--cells", type=int, help="cells per workbook (default 100000)")
+    parser.add_argument("--sheets", type=int)
+    parser.add_argument("--columns", type=int)
+    parser.add_argument("--style-diversity", type=int)
+    parser.add_argument("--border-density", type=float)
+    parser.add_argument("--merges", type=int)
+    parser.add_argument("--merge-size", type=int, help="largest row / column span of a merge")
+    parser.add_argument("--string-ratio", type=float)
+    parser.add_argument("--formula-columns", type=int, help="trailing columns holding filled-down formulas")
+    parser.add_argument("--rich-ratio", type=float, help="share of string cells written as rich text runs")
+    parser.add_argument("--alignment", choices=["none", "basic", "full"],
+                        help="alignment attributes of the generated styles")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--from-json", action="store_true", help="export through export_luckysheet_json")
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    overrides = {name: getattr(args, name) for name in
+                 ["cells", "sheets", "columns", "style_diversity", "border_density", "merges", "merge_size",
+                  "string_ratio", "formula_columns", "rich_ratio", "alignment", "seed"]
+                 if getattr(args, name) is not None}
+
+    cases = []
+    for scenario in args.scenario:
+        params = dict(SCENARIOS[scenario], **overrides)
+        for engine in args.engine:
+            for _ in range(args.repeat):
+                cases.append((scenario, params, engine, ENGINES[engine], args.from_json))
+
+    results = []
+    # One process per case so peak_rss_mb is not inherited from earlier cases
+    with Pool(processes=1, maxtasksperchild=1) as pool:
+        for result in pool.imap(run_case, cases):
+            results.append(result)
+            print("{0:<12} {1:<10} {2:>9} cells  export {3:8.3f}s  {4:>10.0f} cells/s  peak {5:.1f} MB".format(
+                result["scenario"], result["engine"], result["cells"], result["phases"]["export"],
+                result["cells_per_sec"] or 0, result["peak_rss_mb"] or 0), file=sys.stderr, flush=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "openpyxl": openpyxl.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+from main import BORDER_RANGE_LIMIT, export_luckysheet_to_excel
+
+
+SUFFIX = ".xlsx"
+
+
+def payload_hash(data, options=None):
+    # sha256 over a canonical JSON encoding (sorted keys, no whitespace)
+    digest = hashlib.sha256()
+    encoder = json.JSONEncoder(sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    for chunk in encoder.iterencode([data, options or {}]):
+        digest.update(chunk.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class SizeBoundedLRU:
+    """
+    Least recently used bookkeeping bounded by total size in bytes.
+
+    entries maps each key to its size, least recently used first. The
+    store holding the content calls _use on every hit and store, _forget
+    when an entry vanishes, and gets _discard for each evicted key. Shared
+    by ExportCache and xlsx_writer.SheetPartCache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "size_bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _use(self, key, size):
+        # Makes key the most recently used entry, with its current size
+        self.size += size - self.entries.pop(key, 0)
+        self.entries[key] = size
+
+    def _forget(self, key):
+        self.size -= self.entries.pop(key, 0)
+
+    def _evict(self):
+        # The most recent entry is kept even when it alone exceeds max_bytes
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            self._discard(key)
+
+    def _discard(self, key):
+        pass
+
+
+class ExportCache(SizeBoundedLRU):
+    """
+    Bounded on-disk cache of exported workbooks, keyed by payload hash.
+
+    Entries are evicted least recently used first once the store exceeds
+    max_bytes. Recency is kept in file mtimes, so several processes can
+    share a directory and a new instance picks up the existing entries.
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        super().__init__(max_bytes)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                stat = os.stat(os.path.join(self.directory, name))
+                found.append((stat.st_mtime, name[:-len(SUFFIX)], stat.st_size))
+        for _, key, size in sorted(found):
+            self._use(key, size)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process
+            self._forget(key)
+            return None
+        self._use(key, len(content))
+        return content
+
+    def put(self, key, content):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, self._path(key))
+        self._use(key, len(content))
+        self._evict()
+
+    def _discard(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def export(self, data, output_file=None, **options):
+        # Same contract as export_luckysheet_to_excel; data is hashed first, so
+        # generators are materialized
+        if not isinstance(data, (list, tuple)):
+            data = list(data)
+        # Only the options that change the produced file belong in the key
+        key = payload_hash(data, {"engine": options.get("engine", "openpyxl"),
+                                  "write_only": bool(options.get("write_only")),
+                                  "border_range_limit": options.get("border_range_limit", BORDER_RANGE_LIMIT),
+                                  "merge_policy": options.get("merge_policy", "drop"),
+                                  "evaluate": bool(options.get("evaluate")),
+                                  "formulas": bool(options.get("formulas"))})
+
+        content = self.get(key)
+        if content is None:
+            self.misses += 1
+            content = export_luckysheet_to_excel(data, None, **options)
+            self.put(key, content)
+        else:
+            self.hits += 1
+
+        if output_file is None:
+            return content
+        if hasattr(output_file, "write"):
+            output_file.write(content)
+        else:
+            with open(output_file, "wb") as f:
+                f.write(content)
@@ -0,0 +1,633 @@
+import math
+import operator
+import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+from decimal import ROUND_DOWN, ROUND_HALF_UP, ROUND_UP, Decimal
+
+from main import COLUMN_INDEX, formula_shape
+
+
+TOKENS = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)
+  | (?P<error>\#(?:NULL!|DIV/0!|VALUE!|REF!|NAME\?|NUM!|N/A))
+  | (?P<sheet>(?:'(?:[^']|'')+'|[\w.]+)!)
+  | (?P<ref>(?P<col_abs>\$?)(?P<letters>[A-Za-z]{1,3})(?P<row_abs>\$?)(?P<digits>[0-9]+)(?![\w.(]))
+  | (?P<name>[A-Za-z_][\w.]*)
+  | (?P<op><>|<=|>=|[-+*/^&=<>%(),:])
+""", re.VERBOSE)
+
+COMPARISONS = {"=": operator.eq, "<>": operator.ne, "<": operator.lt, ">": operator.gt, "<=": operator.le,
+               ">=": operator.ge}
+
+
+class Unsupported(Exception):
+    # The formula uses syntax or a function the evaluator does not implement
+    pass
+
+
+class FormulaError(Exception):
+    # Raised while evaluating; args[0] is the Excel error code
+    pass
+
+
+class ErrorValue(str):
+    # An Excel error (#DIV/0! ...) held as the value of a cell
+    pass
+
+
+def to_number(value):
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        raise FormulaError("#VALUE!")
+
+
+def to_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float):
+        return "{0:.15g}".format(value)
+    return str(value)
+
+
+def to_bool(value):
+    if value is None:
+        return False
+    if isinstance(value, str):
+        upper = value.upper()
+        if upper not in ("TRUE", "FALSE"):
+            raise FormulaError("#VALUE!")
+        return upper == "TRUE"
+    return bool(value)
+
+
+def compare(op, left, right):
+    # Excel orders numbers < text < booleans; text is compared case-insensitively
+    def rank(value, other):
+        if value is None:
+            value = "" if isinstance(other, str) else False if isinstance(other, bool) else 0
+        if isinstance(value, bool):
+            return 2, value
+        if isinstance(value, str):
+            return 1, value.lower()
+        return 0, value
+    left_rank, right_rank = rank(left, right), rank(right, left)
+    if left_rank[0] != right_rank[0]:
+        return COMPARISONS[op](left_rank[0], right_rank[0])
+    return COMPARISONS[op](left_rank[1], right_rank[1])
+
+
+def numbers(args):
+    # Numbers of a SUM-like argument list: cells in ranges are taken only when
+    # they hold numbers, direct arguments are converted
+    for arg in args:
+        if isinstance(arg, list):
+            for value in arg:
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield value
+        else:
+            yield to_number(arg)
+
+
+def values(args):
+    for arg in args:
+        if isinstance(arg, list):
+            yield from arg
+        else:
+            yield arg
+
+
+def scalar(value):
+    if isinstance(value, list):
+        # A range where a single value is expected
+        raise FormulaError("#VALUE!")
+    return value
+
+
+def round_to(value, digits, rounding):
+    quantum = Decimal(1).scaleb(-int(to_number(digits)))
+    return float(Decimal(repr(float(to_number(value)))).quantize(quantum, rounding=rounding))
+
+
+def average(*args):
+    found = list(numbers(args))
+    if not found:
+        raise FormulaError("#DIV/0!")
+    return sum(found) / len(found)
+
+
+def mod(number, divisor):
+    number, divisor = to_number(number), to_number(divisor)
+    if divisor == 0:
+        raise FormulaError("#DIV/0!")
+    return number - divisor * math.floor(number / divisor)
+
+
+def sqrt(number):
+    number = to_number(number)
+    if number < 0:
+        raise FormulaError("#NUM!")
+    return math.sqrt(number)
+
+
+def mid(text, start, length):
+    start, length = int(to_number(start)), int(to_number(length))
+    if start < 1 or length < 0:
+        raise FormulaError("#VALUE!")
+    return to_text(text)[start - 1:start - 1 + length]
+
+
+def right(text, length=1):
+    length = int(to_number(length))
+    if length < 0:
+        raise FormulaError("#VALUE!")
+    return to_text(text)[len(to_text(text)) - length:] if length else ""
+
+
+# name -> (function, min args, max args or None); arguments arrive evaluated,
+# ranges as lists
+FUNCTIONS = {
+    "SUM": (lambda *args: sum(numbers(args)), 1, None),
+    "PRODUCT": (lambda *args: math.prod(numbers(args)), 1, None),
+    "AVERAGE": (average, 1, None),
+    "MIN": (lambda *args: min(numbers(args), default=0), 1, None),
+    "MAX": (lambda *args: max(numbers(args), default=0), 1, None),
+    "COUNT": (lambda *args: sum(1 for value in values(args)
+                                if isinstance(value, (int, float)) and not isinstance(value, bool)), 1, None),
+    "COUNTA": (lambda *args: sum(1 for value in values(args) if value is not None), 1, None),
+    "ABS": (lambda number: abs(to_number(number)), 1, 1),
+    "INT": (lambda number: math.floor(to_number(number)), 1, 1),
+    "ROUND": (lambda number, digits: round_to(number, digits, ROUND_HALF_UP), 2, 2),
+    "ROUNDUP": (lambda number, digits: round_to(number, digits, ROUND_UP), 2, 2),
+    "ROUNDDOWN": (lambda number, digits: round_to(number, digits, ROUND_DOWN), 2, 2),
+    "MOD": (mod, 2, 2),
+    "POWER": (lambda number, exponent: power(to_number(number), to_number(exponent)), 2, 2),
+    "SQRT": (sqrt, 1, 1),
+    "AND": (lambda *args: all(to_bool(value) for value in values(args) if value is not None), 1, None),
+    "OR": (lambda *args: any(to_bool(value) for value in values(args) if value is not None), 1, None),
+    "NOT": (lambda value: not to_bool(value), 1, 1),
+    "CONCATENATE": (lambda *args: "".join(to_text(scalar(arg)) for arg in args), 1, None),
+    "CONCAT": (lambda *args: "".join(to_text(value) for value in values(args)), 1, None),
+    "LEN": (lambda text: len(to_text(text)), 1, 1),
+    "LEFT": (lambda text, length=1: to_text(text)[:max(int(to_number(length)), 0)], 1, 2),
+    "RIGHT": (right, 1, 2),
+    "MID": (mid, 3, 3),
+    "UPPER": (lambda text: to_text(text).upper(), 1, 1),
+    "LOWER": (lambda text: to_text(text).lower(), 1, 1),
+    "TRIM": (lambda text: " ".join(part for part in to_text(text).split(" ") if part), 1, 1),
+}
+
+
+def binary(op, left, right):
+    if op == "&":
+        return lambda *cell: to_text(scalar(left(*cell))) + to_text(scalar(right(*cell)))
+    if op in COMPARISONS:
+        return lambda *cell: compare(op, scalar(left(*cell)), scalar(right(*cell)))
+    arithmetic = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": divide, "^": power}[op]
+    return lambda *cell: arithmetic(to_number(scalar(left(*cell))), to_number(scalar(right(*cell))))
+
+
+def divide(left, right):
+    if right == 0:
+        raise FormulaError("#DIV/0!")
+    return left / right
+
+
+def power(left, right):
+    try:
+        result = left ** right
+    except (OverflowError, ZeroDivisionError):
+        raise FormulaError("#NUM!")
+    if isinstance(result, complex):
+        raise FormulaError("#NUM!")
+    return result
+
+
+class Parser:
+    """
+    Recursive descent parser from formula text to a Python closure.
+
+    The closure is called as fn(values, sheet, row, col) for the cell that
+    holds the formula. References are kept relative to that cell unless
+    they are absolute ($), so one closure serves every cell a formula was
+    filled into. refs lists what the formula reads: (start,) for a cell and
+    (start, end) for a range, each end as (sheet, row_abs, row, col_abs, col).
+    """
+
+    def __init__(self, formula, row, col, sheets=None):
+        self.tokens = []
+        pos = 1 if formula.startswith("=") else 0
+        while pos < len(formula):
+            match = TOKENS.match(formula, pos)
+            if match is None:
+                raise Unsupported(formula)
+            if match.lastgroup != "space":
+                self.tokens.append(match)
+            pos = match.end()
+        self.pos = 0
+        self.row = row
+        self.col = col
+        self.refs = []
+        # lower-cased name -> name of the sheets in the document, None to not check them
+        self.sheets = sheets
+
+    def peek(self, kind=None, text=None):
+        if self.pos >= len(self.tokens):
+            return None
+        token = self.tokens[self.pos]
+        if kind is not None and token.lastgroup != kind:
+            return None
+        if text is not None and token.group(0).upper() != text:
+            return None
+        return token
+
+    def take(self, kind=None, text=None):
+        token = self.peek(kind, text)
+        if token is None:
+            raise Unsupported("expected {0}".format(text or kind))
+        self.pos += 1
+        return token
+
+    def parse(self):
+        fn = self.comparison()
+        if self.pos != len(self.tokens):
+            raise Unsupported("trailing tokens")
+        return fn, self.refs
+
+    def binary_level(self, operand, ops):
+        fn = operand()
+        while True:
+            token = self.peek("op")
+            if token is None or token.group(0) not in ops:
+                return fn
+            self.pos += 1
+            fn = binary(token.group(0), fn, operand())
+
+    def comparison(self):
+        return self.binary_level(self.concat, COMPARISONS)
+
+    def concat(self):
+        return self.binary_level(self.additive, ("&",))
+
+    def additive(self):
+        return self.binary_level(self.term, ("+", "-"))
+
+    def term(self):
+        return self.binary_level(self.power, ("*", "/"))
+
+    def power(self):
+        return self.binary_level(self.unary, ("^",))
+
+    def unary(self):
+        if self.peek("op", "-"):
+            self.pos += 1
+            operand = self.unary()
+            return lambda *cell: -to_number(scalar(operand(*cell)))
+        if self.peek("op", "+"):
+            self.pos += 1
+            return self.unary()
+        return self.percent()
+
+    def percent(self):
+        fn = self.primary()
+        while self.peek("op", "%"):
+            self.pos += 1
+            fn = (lambda inner: lambda *cell: to_number(scalar(inner(*cell))) / 100)(fn)
+        return fn
+
+    def primary(self):
+        token = self.take()
+        kind, text = token.lastgroup, token.group(0)
+        if kind == "number":
+            value = float(text)
+            value = int(value) if value.is_integer() and abs(value) < 1e15 else value
+            return lambda *cell: value
+        if kind == "string":
+            value = text[1:-1].replace('""', '"')
+            return lambda *cell: value
+        if kind == "error":
+            error = ErrorValue(text)
+            return lambda *cell: raise_error(error)
+        if kind == "sheet":
+            sheet = text[1:-2].replace("''", "'") if text.startswith("'") else text[:-1]
+            return self.reference(self.take("ref"), sheet)
+        if kind == "ref":
+            return self.reference(token, None)
+        if kind == "name":
+            if self.peek("op", "("):
+                return self.function(text.upper())
+            if text.upper() in ("TRUE", "FALSE"):
+                value = text.upper() == "TRUE"
+                return lambda *cell: value
+            raise Unsupported("name {0}".format(text))
+        if text == "(":
+            fn = self.comparison()
+            self.take("op", ")")
+            return fn
+        raise Unsupported(text)
+
+    def ref_spec(self, token, sheet):
+        col_abs, letters, row_abs, digits = token.group("col_abs", "letters", "row_abs", "digits")
+        col = COLUMN_INDEX.get(letters.upper())
+        if col is None:
+            raise Unsupported(token.group(0))
+        # 0-based like Luckysheet r / c; relative parts as offsets from the formula's cell
+        row, col = int(digits) - 1, col - 1
+        return (sheet, bool(row_abs), row if row_abs else row - self.row,
+                bool(col_abs), col if col_abs else col - self.col)
+
+    def reference(self, token, sheet):
+        missing = False
+        if sheet is not None and self.sheets is not None:
+            # Excel compares sheet names case-insensitively
+            missing = sheet.lower() not in self.sheets
+            sheet = self.sheets.get(sheet.lower(), sheet)
+        start = self.ref_spec(token, sheet)
+        end = None
+        if self.peek("op", ":"):
+            self.pos += 1
+            if self.peek("sheet"):
+                self.pos += 1
+            end = self.ref_spec(self.take("ref"), sheet)
+        if missing:
+            return lambda *cell: raise_error("#REF!")
+        if end is None:
+            self.refs.append((start,))
+            return cell_reader(start)
+        self.refs.append((start, end))
+        return range_reader(start, end)
+
+    def function(self, name):
+        if name not in FUNCTIONS and name not in ("IF", "IFERROR"):
+            raise Unsupported("function {0}".format(name))
+        self.take("op", "(")
+        args = []
+        if not self.peek("op", ")"):
+            while True:
+                args.append(self.comparison())
+                if not self.peek("op", ","):
+                    break
+                self.pos += 1
+        self.take("op", ")")
+
+        # IF and IFERROR only evaluate the branch they return
+        if name == "IF":
+            if not 2 <= len(args) <= 3:
+                raise Unsupported(name)
+            condition, then = args[0], args[1]
+            otherwise = args[2] if len(args) == 3 else (lambda *cell: False)
+            return lambda *cell: then(*cell) if to_bool(scalar(condition(*cell))) else otherwise(*cell)
+        if name == "IFERROR":
+            if len(args) != 2:
+                raise Unsupported(name)
+            return iferror(*args)
+
+        impl, least, most = FUNCTIONS[name]
+        if len(args) < least or (most is not None and len(args) > most):
+            raise Unsupported(name)
+        return lambda *cell: impl(*[arg(*cell) for arg in args])
+
+
+def raise_error(error):
+    raise FormulaError(error)
+
+
+def iferror(value, fallback):
+    def fn(*cell):
+        try:
+            return value(*cell)
+        except FormulaError:
+            return fallback(*cell)
+    return fn
+
+
+def cell_reader(spec):
+    sheet, row_abs, row, col_abs, col = spec
+
+    def read(values, host_sheet, host_row, host_col):
+        value = values.get((sheet or host_sheet, row if row_abs else host_row + row,
+                            col if col_abs else host_col + col))
+        if type(value) is ErrorValue:
+            raise FormulaError(value)
+        return value
+    return read
+
+
+def range_reader(start, end):
+    def read(values, host_sheet, host_row, host_col):
+        target, row1, col1, row2, col2 = resolve((start, end), host_sheet, host_row, host_col)
+        found = []
+        for row in range(row1, row2 + 1):
+            for col in range(col1, col2 + 1):
+                value = values.get((target, row, col))
+                if type(value) is ErrorValue:
+                    raise FormulaError(value)
+                found.append(value)
+        return found
+    return read
+
+
+def resolve(ref, host_sheet, host_row, host_col):
+    # An entry of Parser.refs for one formula cell: (sheet, row, col) for a
+    # cell, (sheet, row1, col1, row2, col2) with row1 <= row2 for a range
+    cells = []
+    for sheet, row_abs, row, col_abs, col in ref:
+        cells.append((row if row_abs else host_row + row, col if col_abs else host_col + col))
+    sheet = ref[0][0] or host_sheet
+    if len(cells) == 1:
+        return (sheet,) + cells[0]
+    (row1, col1), (row2, col2) = cells
+    return sheet, min(row1, row2), min(col1, col2), max(row1, row2), max(col1, col2)
+
+
+def normalize(value):
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return ErrorValue("#NUM!")
+        if value.is_integer() and abs(value) < 1e15:
+            return int(value)
+    return value
+
+
+class FormulaGraph:
+    """
+    Dependency graph over the formula cells (f) of a Luckysheet document.
+
+    Formulas are compiled once per distinct shape (the same formula filled
+    down a column compiles once) and evaluated in topological order; the
+    results are written back to each cell's v. Cells whose formula uses
+    something outside the supported subset keep their v and are read as
+    plain values, as are cells on a reference cycle. set_values() changes
+    input cells and re-evaluates only the formulas depending on them.
+
+    Luckysheet's calcChain repeats the f of every formula cell without the
+    references, so the graph is built from the f fields alone.
+    """
+
+    def __init__(self, data):
+        data = list(data)
+        self.sheets = {}
+        self.cells = {}
+        self.values = {}
+        # formula cell -> (fn, cells it reads, ranges it reads as (sheet, r1, c1, r2, c2))
+        self.formulas = {}
+        self.unsupported = 0
+        self.dependents = {}
+        self.range_dependents = {}
+        self.children = {}
+        self.order = {}
+        self.cycles = set()
+        compiled = {}
+        # References to a sheet that is not in data evaluate to #REF!
+        names = {str(sheet_data.get("name")).lower(): sheet_data.get("name") for sheet_data in data}
+
+        for sheet_data in data:
+            name = sheet_data.get("name")
+            self.sheets[name] = sheet_data
+            for cell_info in sheet_data.get("celldata", []):
+                font_info = cell_info["v"]
+                if not isinstance(font_info, dict):
+                    continue
+                key = (name, cell_info["r"], cell_info["c"])
+                self.cells[key] = font_info
+                value = font_info.get("v")
+                formula = font_info.get("f")
+                if formula and isinstance(formula, str):
+                    if value in ("#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#N/A"):
+                        value = ErrorValue(value)
+                    shape = formula_shape(formula, cell_info["r"] + 1, cell_info["c"] + 1)
+                    entry = compiled.get(shape) if shape is not None else None
+                    if entry is None:
+                        try:
+                            entry = Parser(formula, cell_info["r"], cell_info["c"], names).parse()
+                        except Unsupported:
+                            entry = False
+                        if shape is not None:
+                            compiled[shape] = entry
+                    if entry:
+                        self.formulas[key] = entry
+                    else:
+                        self.unsupported += 1
+                self.values[key] = value
+        self._link()
+
+    def _reads(self, key):
+        sheet, row, col = key
+        return [resolve(ref, sheet, row, col) for ref in self.formulas[key][1]]
+
+    def _link(self):
+        rows_by_column = {}
+        for sheet, row, col in self.formulas:
+            rows_by_column.setdefault((sheet, col), []).append(row)
+        for rows in rows_by_column.values():
+            rows.sort()
+
+        # Edges from every cell to the formulas reading it; between formula
+        # cells they also go into children for the topological order
+        indegree = dict.fromkeys(self.formulas, 0)
+        for key in self.formulas:
+            for target in self._reads(key):
+                if len(target) == 3:
+                    self.dependents.setdefault(target, []).append(key)
+                    if target in self.formulas:
+                        self.children.setdefault(target, []).append(key)
+                        indegree[key] += 1
+                    continue
+                sheet, row1, col1, row2, col2 = target
+                self.range_dependents.setdefault(sheet, []).append((row1, col1, row2, col2, key))
+                for col in range(col1, col2 + 1):
+                    rows = rows_by_column.get((sheet, col), ())
+                    for row in rows[bisect_left(rows, row1):bisect_right(rows, row2)]:
+                        self.children.setdefault((sheet, row, col), []).append(key)
+                        indegree[key] += 1
+
+        ready = deque(key for key, count in indegree.items() if count == 0)
+        while ready:
+            key = ready.popleft()
+            self.order[key] = len(self.order)
+            for child in self.children.get(key, ()):
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    ready.append(child)
+        self.cycles = {key for key in self.formulas if key not in self.order}
+
+    def _evaluate(self, keys):
+        values = self.values
+        for key in keys:
+            sheet, row, col = key
+            try:
+                value = scalar(self.formulas[key][0](values, sheet, row, col))
+                # A formula returning an empty cell shows 0, as in Excel
+                value = normalize(0 if value is None else value)
+            except FormulaError as exc:
+                value = ErrorValue(exc.args[0])
+            except ZeroDivisionError:
+                value = ErrorValue("#DIV/0!")
+            except (OverflowError, ValueError, RecursionError):
+                value = ErrorValue("#NUM!")
+            values[key] = value
+            self.cells[key]["v"] = str(value) if type(value) is ErrorValue else value
+        return len(keys)
+
+    def evaluate(self):
+        # Every formula cell outside a cycle, in dependency order; returns the count
+        return self._evaluate(sorted(self.order, key=self.order.get))
+
+    def set_values(self, changes):
+        """
+        Change input cells and re-evaluate the formulas depending on them.
+
+        changes maps (sheet name, r, c), 0-based like celldata, to the new
+        value. Returns the formula cells that were re-evaluated.
+        """
+        affected = set()
+        for key, value in changes.items():
+            if key in self.formulas:
+                raise ValueError("{0} holds a formula".format(key))
+            self.values[key] = value
+            font_info = self.cells.get(key)
+            if font_info is None:
+                font_info = self.cells[key] = {}
+                sheet, row, col = key
+                self.sheets[sheet].setdefault("celldata", []).append({"r": row, "c": col, "v": font_info})
+            font_info["v"] = value
+
+            sheet, row, col = key
+            affected.update(self.dependents.get(key, ()))
+            for row1, col1, row2, col2, formula in self.range_dependents.get(sheet, ()):
+                if row1 <= row <= row2 and col1 <= col <= col2:
+                    affected.add(formula)
+
+        # Everything downstream of the directly affected formulas
+        pending = deque(affected)
+        while pending:
+            for child in self.children.get(pending.popleft(), ()):
+                if child not in affected:
+                    affected.add(child)
+                    pending.append(child)
+        keys = sorted((key for key in affected if key in self.order), key=self.order.get)
+        self._evaluate(keys)
+        return keys
+
+
+def evaluate_formulas(data):
+    """
+    Recompute the cached v of every formula cell in data, in place.
+
+    Returns the FormulaGraph, whose set_values() can later refresh only the
+    formulas affected by a change.
+    """
+    graph = FormulaGraph(data)
+    graph.evaluate()
+    return graph
@@ -0,0 +1,137 @@
+import codecs
+import json
+import os
+import re
+
+
+CHUNK_SIZE = 1 << 16
+
+NON_WHITESPACE = re.compile(r"[^ \t\n\r]")
+
+decoder = json.JSONDecoder()
+
+
+class JsonStreamReader:
+    """
+    Incremental reader over a binary JSON stream.
+
+    Objects and arrays can be walked member by member with members() and
+    items(); anything else is decoded with json's raw_decode once enough
+    text has been buffered. Consumed text is dropped on every refill, so
+    only the value currently being decoded is held as text.
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        chunk = self.stream.read(size)
+        text = self.decoder.decode(chunk, final=not chunk)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def peek(self):
+        # Next non-whitespace character, "" at end of stream
+        while True:
+            match = NON_WHITESPACE.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            if not self._fill(self.chunk_size):
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expecting {0!r} but found {1!r}".format(char, found))
+        self.pos += 1
+
+    def _separator(self, close):
+        found = self.peek()
+        self.pos += 1
+        if found == close:
+            return True
+        if found != ",":
+            raise ValueError("Expecting ',' or {0!r} but found {1!r}".format(close, found))
+        return False
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # A number at the very end of the buffer may still be incomplete
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill(size)
+            size *= 2
+
+    def items(self, read_item):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield read_item()
+            if self._separator("]"):
+                return
+
+    def members(self):
+        # Yields each key; the caller must consume its value before resuming
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self._separator("}"):
+                return
+
+    def sheet(self):
+        sheet_data = {}
+        for key in self.members():
+            if key == "celldata":
+                sheet_data[key] = list(self.items(self.value))
+            else:
+                sheet_data[key] = self.value()
+        return sheet_data
+
+
+def iter_sheets(source, chunk_size=CHUNK_SIZE):
+    """
+    Yield the sheets of a Luckysheet JSON document one at a time.
+
+    source is a file path or a binary stream holding either the list of
+    sheets (as in the main.py sample) or an object with that list under
+    "data". Only the sheet being yielded is kept in memory.
+    """
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, "rb") as stream:
+            yield from iter_sheets(stream, chunk_size)
+        return
+
+    reader = JsonStreamReader(source, chunk_size)
+    if reader.peek() == "{":
+        for key in reader.members():
+            if key == "data":
+                yield from reader.items(reader.sheet)
+            else:
+                reader.value()
+    else:
+        yield from reader.items(reader.sheet)
@@ -1,5 +1,72 @@
+from array import array
+from collections import Counter
+from copy import copy
+from functools import lru_cache
+from io import BytesIO
+from itertools import chain
+from time import perf_counter
+
+import re
+import warnings
+
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.rich_text import CellRichText, TextBlock
+from openpyxl.cell.text import InlineFont
 from openpyxl.styles import Alignment, Font, Border, Side
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.numbers import BUILTIN_FORMATS_MAX_SIZE, BUILTIN_FORMATS_REVERSE
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.cell_range import CellRange
+
+# 1-based: COLUMN_LETTERS[1] == "A", COLUMN_LETTERS[16384] == "XFD"
+COLUMN_LETTERS = [""] + [get_column_letter(col) for col in range(1, 16385)]
+COLUMN_INDEX = {letters: col for col, letters in enumerate(COLUMN_LETTERS) if letters}
+
+# Sheet size, in rows and columns
+MAX_ROW = 1048576
+MAX_COL = 16384
+
+# Sides of a whole column / row range covering more cells than this become column / row styles
+BORDER_RANGE_LIMIT = 1 << 18
+
+# What to do with a merge overlapping an earlier one: raise ValueError, drop it, or shrink it
+MERGE_POLICIES = ("reject", "drop", "clip")
+
+# Characters Excel does not allow in a sheet name
+INVALID_TITLE_CHARS = re.compile(r"[\\/?*\[\]:]")
+
+# Sheet names that can be referenced without quotes, unless they read as a cell (A1)
+UNQUOTED_SHEET_NAME = re.compile(r"[^\W\d][\w.]*")
+CELL_REFERENCE = re.compile(r"[A-Za-z]{1,3}[0-9]+")
+
+# The parts of a formula that matter when it is rewritten or compared: string
+# literals (left alone), sheet prefixes, A1 cell references and whole-row ranges
+FORMULA_TOKENS = re.compile(r"""
+    (?P<string>"(?:[^"]|"")*")
+  | (?P<sheet>(?:'(?:[^']|'')+'|(?<![\w.'])[\w.]+)!)
+  | (?P<cell>(?<![\w.$])(?P<col_abs>\$?)(?P<letters>[A-Za-z]{1,3})(?P<row_abs>\$?)(?P<digits>[0-9]+)(?![\w.(!]))
+  | (?P<rows>(?<![\w.$:])\$?[0-9]+:\$?[0-9]+(?![\w.]))
+""", re.VERBOSE)
+
+# Luckysheet ht / vt / tr -> Excel horizontal, vertical and textRotation (255: stacked)
+HORIZONTAL_ALIGNMENTS = {"0": "center", "1": "left", "2": "right"}
+VERTICAL_ALIGNMENTS = {"0": "center", "1": "top", "2": "bottom"}
+TEXT_ROTATIONS = {"1": 45, "2": 135, "3": 255, "4": 90, "5": 180}
+
+# borderType -> (sides drawn on the outer edges of a range, sides drawn between its cells)
+BORDER_TYPE_EDGES = {
+    "border-all": ("lrtb", "lrtb"),
+    "border-outside": ("lrtb", ""),
+    "border-inside": ("", "lrtb"),
+    "border-horizontal": ("", "tb"),
+    "border-vertical": ("", "lr"),
+    "border-left": ("l", ""),
+    "border-right": ("r", ""),
+    "border-top": ("t", ""),
+    "border-bottom": ("b", ""),
+    "border-none": ("lrtb", "lrtb"),
+}
 
 
 def rgb_string_to_hex(rgb_string):
@@ -36,56 +103,284 @@ def map_border_style(style):
     return border_style_map.get(style, "thin")  # Default to 'thin' border style
 
 
-def export_luckysheet_to_excel(data, output_file):
+def export_luckysheet_to_excel(data, output_file=None, write_only=False, style_cache=None, engine="openpyxl",
+                               max_workers=None, stats=None, cache=None, part_cache=None,
+                               border_range_limit=BORDER_RANGE_LIMIT, merge_policy="drop", evaluate=False,
+                               formulas=False):
+    # output_file: 文件路径或可写的二进制流; 为 None 时返回 xlsx 的 bytes
+    # stats: 可选的 ExportStats, 记录每个阶段的耗时
+    # cache: 可选的 export_cache.ExportCache, 相同内容直接返回已生成的文件
+    # part_cache: 可选的 xlsx_writer.SheetPartCache, 只重新生成内容有变化的 sheet (engine="native")
+    # border_range_limit: 覆盖整列/整行的边框范围, 一条边超过这么多单元格时写成整列/整行的样式, None 表示不限制
+    # merge_policy: 合并区域重叠时的处理方式, "reject" 抛出 ValueError, "drop" 丢弃后面的, "clip" 裁剪后面的
+    # evaluate: 导出前按依赖顺序重新计算公式单元格的 v (直接修改 data), 见 formula_eval
+    # formulas: openpyxl 引擎写出公式 f 而不是 v (openpyxl 不能同时保存两者); native 引擎总是同时写出
+    if merge_policy not in MERGE_POLICIES:
+        raise ValueError("Unknown merge_policy: {0}".format(merge_policy))
+    if evaluate and formulas and engine != "native":
+        # openpyxl 写出公式时不保存 v, 重新计算的结果会被丢掉
+        raise ValueError("evaluate with formulas=True requires engine='native'")
+
+    if cache is not None:
+        return cache.export(data, output_file, write_only=write_only, style_cache=style_cache, engine=engine,
+                            max_workers=max_workers, stats=stats, part_cache=part_cache,
+                            border_range_limit=border_range_limit, merge_policy=merge_policy, evaluate=evaluate,
+                            formulas=formulas)
+
+    if output_file is None:
+        output = BytesIO()
+        export_luckysheet_to_excel(data, output, write_only, style_cache, engine, max_workers, stats, None, part_cache,
+                                   border_range_limit, merge_policy, evaluate, formulas)
+        return output.getvalue()
+
+    if evaluate:
+        from formula_eval import evaluate_formulas
+        if not isinstance(data, list):
+            data = list(data)
+        start = perf_counter() if stats is not None else None
+        graph = evaluate_formulas(data)
+        if stats is not None:
+            stats.record(None, "evaluate", start, len(graph.order))
+
+    if engine == "native":
+        # 直接生成 SpreadsheetML, 不经过 openpyxl 对象模型
+        # max_workers > 1 时每个 sheet 在单独的进程中生成
+        from xlsx_writer import write_xlsx
+        write_xlsx(data, output_file, max_workers, stats, part_cache, border_range_limit, merge_policy)
+        return
+    if engine != "openpyxl":
+        raise ValueError("Unknown engine: {0}".format(engine))
+    if max_workers and max_workers > 1:
+        raise ValueError("max_workers requires engine='native'")
+    if part_cache is not None:
+        raise ValueError("part_cache requires engine='native'")
+
+    if style_cache is None:
+        style_cache = StyleCache()
+
+    if write_only:
+        # 只写模式: 每个 sheet 按行顺序 append, 不在内存中保留 Cell 对象
+        wb = openpyxl.Workbook(write_only=True)
+        titles = sheet_titles(data)
+        for sheet_data in data:
+            ws = wb.create_sheet(titles.add(sheet_data.get("name") or "Sheet"))
+            stream_sheet(ws, sheet_data, style_cache, stats, border_range_limit, merge_policy,
+                         titles.referenced(sheet_data) if formulas else None)
+        start = perf_counter() if stats is not None else None
+        wb.save(output_file)
+        if stats is not None:
+            stats.record(None, "save", start)
+        return
+
     wb = openpyxl.Workbook()
-    ws = wb.active
-
-    for sheet_data in data:
-        sheet_name = sheet_data.get("name", "Sheet")
-        ws.title = sheet_name
-        cell_data = sheet_data.get("celldata", [])
-        config_data = sheet_data.get("config", {})
-        merge_data = config_data.get("merge", {})
-        column_len_data = config_data.get("columnlen", {})
-        row_len_data = config_data.get("rowlen", {})
-        border_info_data = config_data.get("borderInfo", [])
-
-        for col_index, col_width in column_len_data.items():
-            ws.column_dimensions[chr(65 + int(col_index))].width = col_width/10
-
-        for row_index, row_height in row_len_data.items():
-            ws.row_dimensions[int(row_index) + 1].height = row_height
-
-        for border_info in border_info_data:
-            if border_info["rangeType"] == "cell":
-                row_index = border_info["value"]["row_index"]
-                col_index = border_info["value"]["col_index"]
-                cell = ws.cell(row=row_index + 1, column=col_index + 1)
-                apply_border_styles(cell, border_info["value"])
-            elif border_info["rangeType"] == "range":
-                for range_data in border_info["range"]:
-                    apply_border_styles_range(ws, range_data, border_info["color"], border_info["style"])
-
-        for cell_info in cell_data:
-            row_index = cell_info["r"]
-            col_index = cell_info["c"]
-            try:
-                cell_value = cell_info["v"]["v"]
-            except:
-                cell_value = None
-                print('')
-            cell = ws.cell(row=row_index + 1, column=col_index + 1, value=cell_value)
-
-            font_info = cell_info["v"]
-            apply_font_styles(cell, font_info)
-
-        for merge_key, merge_info in merge_data.items():
-            row_index = merge_info["r"]
-            col_index = merge_info["c"]
-            row_span = merge_info["rs"]
-            col_span = merge_info["cs"]
-            merge_range(ws, row_index, col_index, row_span, col_span)
+    titles = sheet_titles(data)
+
+    for index, sheet_data in enumerate(data):
+        ws = wb.active if index == 0 else wb.create_sheet()
+        # Excel 不接受的 sheet 名称会被替换, 公式里的跨 sheet 引用同样替换
+        ws.title = titles.add(sheet_data.get("name") or "Sheet")
+        write_sheet(ws, sheet_data, style_cache, stats, border_range_limit, merge_policy,
+                    titles.referenced(sheet_data) if formulas else None)
+    start = perf_counter() if stats is not None else None
     wb.save(output_file)
+    if stats is not None:
+        stats.record(None, "save", start)
+
+
+def export_luckysheet_json(source, output_file=None, **kwargs):
+    # 从 JSON 文件路径或二进制流逐个 sheet 读取并导出, 参数同 export_luckysheet_to_excel
+    from luckysheet_json import iter_sheets
+    return export_luckysheet_to_excel(iter_sheets(source), output_file, **kwargs)
+
+
+def write_sheet(ws, sheet_data, style_cache=None, stats=None, border_range_limit=BORDER_RANGE_LIMIT,
+                merge_policy="drop", formula_titles=None):
+    # formula_titles: SheetTitles.referenced() of the sheet when formulas are written, None to write v
+    sheet_name = sheet_data.get("name", "Sheet")
+    cell_data = sheet_data.get("celldata", [])
+    config_data = sheet_data.get("config", {})
+    column_len_data = config_data.get("columnlen", {})
+    row_len_data = config_data.get("rowlen", {})
+    border_info_data = config_data.get("borderInfo", [])
+    start = perf_counter() if stats is not None else None
+
+    for row_index, row_height in row_len_data.items():
+        ws.row_dimensions[int(row_index) + 1].height = row_height
+    if stats is not None:
+        start = stats.record(sheet_name, "row_heights", start, len(row_len_data))
+
+    # 先合并所有 borderInfo, 每个单元格只设置一次边框
+    # 覆盖整列/整行且超过 border_range_limit 个单元格的边写成列/行的默认样式
+    borders, column_borders, row_borders = resolve_borders(
+        border_info_data, ((cell_info["r"] + 1, cell_info["c"] + 1) for cell_info in cell_data), border_range_limit)
+    for row, key in row_borders.items():
+        apply_border_key(ws.row_dimensions[row], key, style_cache)
+    for (row, col), key in borders.items():
+        apply_border_key(ws.cell(row=row, column=col), key, style_cache)
+    if stats is not None:
+        start = stats.record(sheet_name, "borders", start, len(borders))
+
+    # 宽度和边框相同的相邻列合并成一个 <col min max>
+    widths = {int(col_index) + 1: col_width / 10 for col_index, col_width in column_len_data.items()}
+    spans = column_spans(widths, column_borders)
+    for min_col, max_col, width, key in spans:
+        dimension = ws.column_dimensions[COLUMN_LETTERS[min_col]]
+        dimension.min = min_col
+        dimension.max = max_col
+        if width is not None:
+            dimension.width = width
+        if key is not None:
+            apply_border_key(dimension, key, style_cache)
+    if stats is not None:
+        start = stats.record(sheet_name, "columns", start, len(spans))
+
+    for cell_info in cell_data:
+        row_index = cell_info["r"]
+        col_index = cell_info["c"]
+        font_info = cell_info["v"]
+        cell = ws.cell(row=row_index + 1, column=col_index + 1, value=cell_value(font_info, formula_titles))
+
+        apply_font_styles(cell, font_info, style_cache)
+        apply_number_format(cell, font_info.get("ct"), style_cache)
+    if stats is not None:
+        start = stats.record(sheet_name, "cells", start, len(cell_data))
+
+    merges = collect_merges(sheet_data, merge_policy)
+    for min_row, min_col, max_row, max_col in merges:
+        merge_range(ws, min_row, min_col, max_row, max_col, borders, style_cache)
+    if stats is not None:
+        stats.record(sheet_name, "merges", start, len(merges))
+
+
+def cell_value(font_info, formula_titles=None):
+    # Value written for a celldata v: its formula when formula_titles is
+    # given, else rich text from ct or the plain v
+    try:
+        value = font_info["v"]
+    except:
+        value = None
+    if font_info.get("f") and formula_titles is not None:
+        # openpyxl 不能同时保存公式和缓存值, 由 Excel 打开时重新计算
+        # 引用了不存在的 sheet 的公式只写出 v
+        formula = rename_sheet_refs(font_info["f"], formula_titles)
+        if formula is not None:
+            return formula
+    if font_info.get("ct") and not font_info.get("f"):
+        return rich_text(font_info["ct"]) or value
+    return value
+
+
+def stream_sheet(ws, sheet_data, style_cache, stats=None, border_range_limit=BORDER_RANGE_LIMIT,
+                 merge_policy="drop", formula_titles=None):
+    # write_sheet for a write-only worksheet: the same cells and styles, but
+    # appended row by row from a sorted index over celldata, so no Cell
+    # objects are kept. style_cache is required
+    sheet_name = sheet_data.get("name", "Sheet")
+    cell_data = sheet_data.get("celldata", [])
+    config_data = sheet_data.get("config", {})
+    start = perf_counter() if stats is not None else None
+
+    for row_index, row_height in config_data.get("rowlen", {}).items():
+        ws.row_dimensions[int(row_index) + 1].height = row_height
+    if stats is not None:
+        start = stats.record(sheet_name, "row_heights", start, len(config_data.get("rowlen", {})))
+
+    borders, column_borders, row_borders = resolve_borders(
+        config_data.get("borderInfo", []), ((cell_info["r"] + 1, cell_info["c"] + 1) for cell_info in cell_data),
+        border_range_limit)
+    for row, key in row_borders.items():
+        apply_border_key(ws.row_dimensions[row], key, style_cache)
+    if stats is not None:
+        start = stats.record(sheet_name, "borders", start, len(borders))
+
+    # Columns are written with the first row, before any cell
+    widths = {int(col_index) + 1: col_width / 10 for col_index, col_width in config_data.get("columnlen", {}).items()}
+    spans = column_spans(widths, column_borders)
+    for min_col, max_col, width, key in spans:
+        dimension = ws.column_dimensions[COLUMN_LETTERS[min_col]]
+        dimension.min = min_col
+        dimension.max = max_col
+        if width is not None:
+            dimension.width = width
+        if key is not None:
+            apply_border_key(dimension, key, style_cache)
+    if stats is not None:
+        start = stats.record(sheet_name, "columns", start, len(spans))
+
+    # Covered cells are dropped; the perimeter gets the borders of merge_border_edges
+    merges = collect_merges(sheet_data, merge_policy)
+    index = MergeIndex() if merges else None
+    for merge in merges:
+        min_row, min_col, max_row, max_col = merge
+        index.add(merge)
+        edges = merge_border_edges(borders.get((min_row, min_col)),
+                                   borders.get((max_row, max_col)) if merge[:2] != merge[2:] else None,
+                                   min_row, min_col, max_row, max_col)
+        drop_covered(borders, min_row, min_col, max_row, max_col)
+        borders.update(edges)
+        ws.merged_cells.ranges.add(CellRange(min_col=min_col, min_row=min_row, max_col=max_col, max_row=max_row))
+    if stats is not None:
+        start = stats.record(sheet_name, "merges", start, len(merges))
+
+    # Cells as (row, col, celldata index), -1 for the border of a cell
+    rows, cols, entries = array("i"), array("i"), array("i")
+    for position, cell_info in enumerate(cell_data):
+        row, col = cell_info["r"] + 1, cell_info["c"] + 1
+        if index is not None:
+            merge = index.find(row, col)
+            if merge is not None and (merge[0] != row or merge[1] != col):
+                continue
+        rows.append(row)
+        cols.append(col)
+        entries.append(position)
+    for row, col in borders:
+        rows.append(row)
+        cols.append(col)
+        entries.append(-1)
+    # Stable, so a cell given twice is written over in celldata order as ws.cell does
+    order = array("i", sorted(range(len(rows)), key=lambda position: rows[position] << 15 | cols[position]))
+    for cells in sheet_rows(ws, cell_data, order, rows, cols, entries, borders, style_cache, formula_titles):
+        ws.append(cells)
+    if stats is not None:
+        stats.record(sheet_name, "cells", start, len(order))
+
+
+def sheet_rows(ws, cell_data, order, rows, cols, entries, borders, style_cache, formula_titles=None):
+    # Rows for ws.append from 1 up to the last cell or row dimension, styles
+    # resolved as each row is reached. append numbers rows by position, so
+    # each row in between is an empty list: a sheet with cells far apart is
+    # quicker to export with engine="native", which skips empty rows
+    last_row = max(chain((rows[position] for position in order[-1:]), ws.row_dimensions, [0]))
+    next_row = 1
+    position = 0
+    while next_row <= last_row:
+        if position == len(order) or rows[order[position]] != next_row:
+            yield []
+            next_row += 1
+            continue
+        cells = []
+        while position < len(order) and rows[order[position]] == next_row:
+            first = order[position]
+            col = cols[first]
+            cell = WriteOnlyCell(ws)
+            # A cell given twice in celldata is written over in order, as ws.cell does
+            while position < len(order) and rows[order[position]] == next_row and cols[order[position]] == col:
+                entry = entries[order[position]]
+                position += 1
+                if entry < 0:
+                    apply_border_key(cell, borders[next_row, col], style_cache)
+                    continue
+                font_info = cell_data[entry]["v"]
+                value = cell_value(font_info, formula_titles)
+                if value is not None:
+                    cell.value = value
+                apply_font_styles(cell, font_info, style_cache)
+                apply_number_format(cell, font_info.get("ct"), style_cache)
+            cells.extend([None] * (col - len(cells) - 1))
+            cells.append(cell)
+        yield cells
+        next_row += 1
+
 
 def font_type(f_id):
     font_type_map = {
@@ -104,60 +399,878 @@ def font_type(f_id):
         "12": "thick"
         # Add other mapping relationships
     }
-    return font_type_map[str(f_id)]
+    if isinstance(f_id, str) and not f_id.isdigit():
+        # 富文本的 ct.s 里直接写字体名称, 可能带引号: '"times new roman"'
+        return f_id.strip("\"'") or None
+    # 未知的字体编号不再报错, 使用默认字体
+    return font_type_map.get(str(f_id))
+
 
-def apply_font_styles(cell, font_info):
+# Luckysheet un -> Excel underline
+UNDERLINES = {"1": "single", "2": "double", "3": "singleAccounting", "4": "doubleAccounting"}
+
+
+def font_style_key(font_info):
+    # Raw attributes as the payload has them; normalized once per distinct combination
+    return normalize_font_key((font_info.get("fs"), font_info.get("bl"), font_info.get("it"), font_info.get("un"),
+                               font_info.get("cl"), font_info.get("fc"), font_info.get("ff")))
+
+
+def is_set(flag):
+    return flag == 1 or flag == "1"
+
+
+@lru_cache(maxsize=4096)
+def normalize_font_key(raw):
+    # (size, bold, italic, underline, strike, color hex, name); payloads that
+    # only differ in how they spell a value ("1" / 1, rgb() / #hex) share a key
+    size, bold, italic, underline, strike, color, name = raw
+    return (size or None, is_set(bold), is_set(italic), UNDERLINES.get(str(underline)), is_set(strike),
+            rgb_string_to_hex(color) if color else None, None if name is None or name == "" else font_type(name))
+
+
+def build_font(key):
+    size, bold, italic, underline, strike, color, name = key
     font = Font()
-    if font_info.get("fs"):
-        font.size = font_info["fs"]
-    if font_info.get("bl") and font_info["bl"] == 1:
+    if size:
+        font.size = size
+    if bold:
         font.bold = True
-    if font_info.get("it") and font_info["it"] == 1:
+    if italic:
         font.italic = True
-    if font_info.get("fc"):
-        font.color = rgb_string_to_hex(font_info["fc"])
-    if font_info.get("ff"):
-        font.name = font_type(font_info["ff"])
-    if font_info.get("bg"):
-        cell.fill = openpyxl.styles.PatternFill("solid", fgColor=rgb_string_to_hex(font_info["bg"]))
+    if underline:
+        font.underline = underline
+    if strike:
+        font.strike = True
+    if color:
+        font.color = color
+    if name:
+        font.name = name
+    return font
+
+
+class RunFont(InlineFont):
+    """
+    InlineFont that builds its <rPr> element once.
+
+    openpyxl serialises the font of every rich text run again for each
+    cell; run_font hands out one RunFont per font key, so the element is
+    built once and copied. RunFonts must not be changed after the first
+    write.
+    """
+
+    # Serialisable only collects the descriptors declared in the class body itself
+    __attrs__ = InlineFont.__attrs__
+    __nested__ = InlineFont.__nested__
+    __elements__ = InlineFont.__elements__
+
+    _tree = None
+
+    def to_tree(self, tagname=None, idx=None, namespace=None):
+        if self._tree is None or self._tree.tag != tagname:
+            self._tree = super().to_tree(tagname, idx, namespace)
+        # A copy: an element can only have one parent under lxml
+        return copy(self._tree)
+
+
+@lru_cache(maxsize=1024)
+def run_font(key):
+    # Rich text runs with the same font share one RunFont
+    size, bold, italic, underline, strike, color, name = key
+    font = RunFont()
+    if size:
+        font.sz = size
+    if bold:
+        font.b = True
+    if italic:
+        font.i = True
+    if underline:
+        font.u = underline
+    if strike:
+        font.strike = True
+    if color:
+        font.color = color
+    if name:
+        font.rFont = name
+    return font
+
+
+def rich_text_runs(cell_type):
+    # Luckysheet rich text: ct.t == "inlineStr" with the runs in ct.s, each
+    # holding its text in v and its own font attributes; [(font_key, text)]
+    if not cell_type or cell_type.get("t") != "inlineStr" or not cell_type.get("s"):
+        return None
+    return [(font_style_key(run), str(run["v"])) for run in cell_type["s"] if run.get("v") not in (None, "")]
+
+
+def rich_text(cell_type):
+    runs = rich_text_runs(cell_type)
+    if not runs:
+        return None
+    return CellRichText([TextBlock(run_font(key), text) for key, text in runs])
+
+
+def alignment_key(font_info):
+    # None when the cell sets no alignment at all
+    key = (font_info.get("ht"), font_info.get("vt"), font_info.get("tb"), font_info.get("tr"))
+    return None if key == (None, None, None, None) else key
+
+
+@lru_cache(maxsize=256)
+def alignment_values(key):
+    # (horizontal, vertical, wrap_text, text_rotation); tb "2" is 自动换行
+    ht, vt, tb, tr = key
+    return (HORIZONTAL_ALIGNMENTS.get(str(ht)), VERTICAL_ALIGNMENTS.get(str(vt)), str(tb) == "2",
+            TEXT_ROTATIONS.get(str(tr), 0))
+
+
+@lru_cache(maxsize=256)
+def build_alignment(key):
+    horizontal, vertical, wrap_text, text_rotation = alignment_values(key)
+    return Alignment(horizontal=horizontal, vertical=vertical, wrap_text=wrap_text or None,
+                     text_rotation=text_rotation)
+
+
+def build_fill(bg):
+    return openpyxl.styles.PatternFill("solid", fgColor=rgb_string_to_hex(bg))
+
+
+def border_side_key(side_info):
+    if not side_info:
+        return None
+    return side_info["style"], side_info["color"]
+
+
+def border_style_key(border_info):
+    return (border_side_key(border_info.get("l")), border_side_key(border_info.get("r")),
+            border_side_key(border_info.get("t")), border_side_key(border_info.get("b")))
+
+
+def border_type_edges(border_type, rows, cols):
+    # (side, first_row, last_row, first_col, last_col) for every side the
+    # borderType draws, side being an index into (left, right, top, bottom).
+    # Each side covers one rectangle, so outside borders only visit the perimeter
+    outer, inner = BORDER_TYPE_EDGES[border_type]
+    r1, r2 = rows
+    c1, c2 = cols
+    edges = []
+    if "l" in outer or "l" in inner:
+        edges.append((0, r1, r2, c1 if "l" in outer else c1 + 1, c2 if "l" in inner else c1))
+    if "r" in outer or "r" in inner:
+        edges.append((1, r1, r2, c1 if "r" in inner else c2, c2 if "r" in outer else c2 - 1))
+    if "t" in outer or "t" in inner:
+        edges.append((2, r1 if "t" in outer else r1 + 1, r2 if "t" in inner else r1, c1, c2))
+    if "b" in outer or "b" in inner:
+        edges.append((3, r1 if "b" in inner else r2, r2 if "b" in outer else r2 - 1, c1, c2))
+    if border_type == "border-none":
+        # The lines around the range are also stored on the neighbouring cells
+        edges.extend([(1, r1, r2, c1 - 1, c1 - 1), (0, r1, r2, c2 + 1, c2 + 1),
+                      (3, r1 - 1, r1 - 1, c1, c2), (2, r2 + 1, r2 + 1, c1, c2)])
+    # Neighbours of a range at the edge of the sheet do not exist
+    return [(side, max(first_row, 0), min(last_row, MAX_ROW - 1), max(first_col, 0), min(last_col, MAX_COL - 1))
+            for side, first_row, last_row, first_col, last_col in edges
+            if first_row < MAX_ROW and last_row >= 0 and first_col < MAX_COL and last_col >= 0]
+
+
+def resolve_borders(border_info_data, cell_coords=(), range_limit=None):
+    """
+    Fold borderInfo into the border each cell ends up with.
+
+    Returns (borders, column_borders, row_borders): (row, col) -> border key
+    and column / row -> border key, all 1-based, a key being the (left,
+    right, top, bottom) sides. Entries are applied in list order and a
+    later entry only replaces the sides it sets.
+
+    A side covering more than range_limit cells that runs the whole height
+    of the sheet (or its whole width) is not expanded cell by cell but kept
+    as a column (or row) default style; where the side stops one cell short
+    of the sheet edge, as inner lines do, that cell keeps its own border.
+    Sides of bounded ranges are always expanded cell by cell.
+
+    As in Excel, a cell without a border of its own takes the style of its
+    row if the row has one, otherwise that of its column. Where a band
+    would change a cell that the other direction decides, the cell gets a
+    border of its own. The cells at cell_coords get their band's sides as
+    well, since a cell style replaces the column or row style.
+    """
+    borders = {}
+    column_borders = {}
+    row_borders = {}
+    empty = (None, None, None, None)
+
+    def base(coord):
+        key = row_borders.get(coord[0])
+        if key is None:
+            key = column_borders.get(coord[1], empty)
+        return key
+
+    def store(coord, key):
+        # Keys equal to the band are not needed for empty cells, cell_coords get them back below
+        if key != base(coord):
+            borders[coord] = key
+        else:
+            borders.pop(coord, None)
+
+    def set_side(coord, side, value):
+        key = borders.get(coord)
+        if key is None:
+            key = base(coord)
+            if key[side] == value:
+                return
+        store(coord, key[:side] + (value,) + key[side + 1:])
+
+    def pin(coord, key):
+        # Keeps the current border of a cell whose band is about to change
+        if coord not in borders:
+            borders[coord] = key
+
+    def set_column_band(first, last, side, value, outside):
+        # outside: rows at the sheet edge the side does not reach
+        kept = {(row, col): (borders.get((row, col)) or base((row, col)))[side]
+                for row in outside for col in range(first, last + 1)}
+        # Cells of banded rows follow the row band. A side over most columns
+        # goes into the row bands, and the other columns keep their border
+        most = 2 * (last - first + 1) > MAX_COL
+        for row, key in row_borders.items():
+            cols = chain(range(1, first), range(last + 1, MAX_COL + 1)) if most else range(first, last + 1)
+            for col in cols:
+                pin((row, col), key)
+        for col in range(first, last + 1):
+            key = column_borders.get(col, empty)
+            key = key[:side] + (value,) + key[side + 1:]
+            if any(key):
+                column_borders[col] = key
+            else:
+                column_borders.pop(col, None)
+        if most:
+            for row, key in row_borders.items():
+                row_borders[row] = key[:side] + (value,) + key[side + 1:]
+        for coord, key in list(borders.items()):
+            if first <= coord[1] <= last:
+                store(coord, key[:side] + (value,) + key[side + 1:])
+        for coord, old in kept.items():
+            set_side(coord, side, old)
 
-    cell.font = font
+    def set_row_band(first, last, side, value, outside):
+        # outside: columns at the sheet edge the side does not reach
+        kept = {(row, col): (borders.get((row, col)) or base((row, col)))[side]
+                for col in outside for row in range(first, last + 1)}
+        # A row without a band so far starts from the most common column
+        # key; the columns with another key keep it as a border of their own
+        counts = Counter(column_borders.values())
+        counts[empty] += MAX_COL - len(column_borders)
+        common = counts.most_common(1)[0][0]
+        exceptions = [(col, key) for col, key in column_borders.items() if key != common]
+        if common != empty:
+            exceptions.extend((col, empty) for col in range(1, MAX_COL + 1) if col not in column_borders)
+        for row in range(first, last + 1):
+            key = row_borders.get(row)
+            if key is None:
+                key = common
+                for col, old in exceptions:
+                    pin((row, col), old)
+            key = key[:side] + (value,) + key[side + 1:]
+            if any(key) or column_borders:
+                row_borders[row] = key
+            else:
+                row_borders.pop(row, None)
+        for coord, key in list(borders.items()):
+            if first <= coord[0] <= last:
+                store(coord, key[:side] + (value,) + key[side + 1:])
+        for coord, old in kept.items():
+            set_side(coord, side, old)
 
+    for border_info in border_info_data:
+        if border_info["rangeType"] == "cell":
+            value = border_info["value"]
+            coord = (value["row_index"] + 1, value["col_index"] + 1)
+            # A side set to null clears it, a missing side is left as it was
+            previous = borders.get(coord) or base(coord)
+            store(coord, tuple(border_side_key(value[side]) if side in value else old
+                               for side, old in zip("lrtb", previous)))
+        elif border_info["rangeType"] == "range":
+            border_type = border_info.get("borderType") or "border-all"
+            if border_type not in BORDER_TYPE_EDGES:
+                continue
+            side_key = None if border_type == "border-none" else (border_info["style"], border_info["color"])
+            for range_data in border_info["range"]:
+                rows = range_data.get("row", [])
+                cols = range_data.get("column", [])
+                area = (rows[1] - rows[0] + 1) * (cols[1] - cols[0] + 1)
+                if border_type == "border-all" and (range_limit is None or area <= range_limit):
+                    key = (side_key,) * 4
+                    for row_index in range(rows[0] + 1, rows[1] + 2):
+                        for col_index in range(cols[0] + 1, cols[1] + 2):
+                            borders[(row_index, col_index)] = key
+                    continue
+                for side, first_row, last_row, first_col, last_col in border_type_edges(border_type, rows, cols):
+                    height = last_row - first_row + 1
+                    width = last_col - first_col + 1
+                    if (range_limit is not None and height > 0 and width > 0 and height * width > range_limit
+                            and (height >= MAX_ROW - 1 or width >= MAX_COL - 1)):
+                        if height >= MAX_ROW - 1:
+                            outside = [row for row in (1, MAX_ROW) if not first_row < row <= last_row + 1]
+                            set_column_band(first_col + 1, last_col + 1, side, side_key, outside)
+                        else:
+                            outside = [col for col in (1, MAX_COL) if not first_col < col <= last_col + 1]
+                            set_row_band(first_row + 1, last_row + 1, side, side_key, outside)
+                        continue
+                    for row_index in range(first_row + 1, last_row + 2):
+                        for col_index in range(first_col + 1, last_col + 2):
+                            set_side((row_index, col_index), side, side_key)
 
-def apply_border_styles(cell, border_info):
+    if column_borders or row_borders:
+        for coord in cell_coords:
+            if coord not in borders:
+                key = base(coord)
+                if any(key):
+                    borders[coord] = key
+    return borders, column_borders, row_borders
+
+
+def column_spans(widths, column_borders):
+    # [min_col, max_col, width, border_key] runs of adjacent columns sharing width and border
+    spans = []
+    for col in sorted(widths.keys() | column_borders.keys()):
+        width = widths.get(col)
+        key = column_borders.get(col)
+        if spans and spans[-1][1] == col - 1 and spans[-1][2] == width and spans[-1][3] == key:
+            spans[-1][1] = col
+        else:
+            spans.append([col, col, width, key])
+    return spans
+
+
+def build_border(key):
     border = Border()
-    if border_info.get("l"):
-        border.left = Side(style=map_border_style(border_info["l"]["style"]),
-                           color=rgb_string_to_hex(border_info["l"]["color"]))
-    if border_info.get("r"):
-        border.right = Side(style=map_border_style(border_info["r"]["style"]),
-                            color=rgb_string_to_hex(border_info["r"]["color"]))
-    if border_info.get("t"):
-        border.top = Side(style=map_border_style(border_info["t"]["style"]),
-                          color=rgb_string_to_hex(border_info["t"]["color"]))
-    if border_info.get("b"):
-        border.bottom = Side(style=map_border_style(border_info["b"]["style"]),
-                             color=rgb_string_to_hex(border_info["b"]["color"]))
-
-    cell.border = border
-
-
-def apply_border_styles_range(ws, range_data, color, style):
-    rows = range_data.get("row", [])
-    cols = range_data.get("column", [])
-    for row_index in range(rows[0], rows[1] + 1):
-        for col_index in range(cols[0], cols[1] + 1):
-            cell = ws.cell(row=row_index + 1, column=col_index + 1)
-            border = Border()
-            border.left = Side(style=map_border_style(style), color=color.replace('#', ''))
-            border.right = Side(style=map_border_style(style), color=color.replace('#', ''))
-            border.top = Side(style=map_border_style(style), color=color.replace('#', ''))
-            border.bottom = Side(style=map_border_style(style), color=color.replace('#', ''))
-            cell.border = border
-
-
-def merge_range(ws, row_index, col_index, row_span, col_span):
-    ws.merge_cells(start_row=row_index + 1, start_column=col_index + 1, end_row=row_index + row_span, end_column=col_index + col_span)
+    sides = [Side(style=map_border_style(side[0]), color=rgb_string_to_hex(side[1])) if side else None
+             for side in key]
+    if sides[0]:
+        border.left = sides[0]
+    if sides[1]:
+        border.right = sides[1]
+    if sides[2]:
+        border.top = sides[2]
+    if sides[3]:
+        border.bottom = sides[3]
+    return border
+
+
+class StyleCache:
+    """
+    Interns openpyxl style objects by their Luckysheet style key.
+
+    Each distinct key is built and registered with the workbook once; later
+    cells only get the registered id written into their StyleArray, which
+    is what assigning cell.font / cell.fill / cell.border does internally.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._workbook = None
+        self._ids = {}
+
+    def style_id(self, wb, collection, key, build):
+        if wb is not self._workbook:
+            self._workbook = wb
+            self._ids = {}
+        try:
+            style_id = self._ids[collection, key]
+        except KeyError:
+            self.misses += 1
+            style_id = self._ids[collection, key] = getattr(wb, collection).add(build(key))
+            return style_id
+        self.hits += 1
+        return style_id
+
+
+def style_array(cell):
+    if cell._style is None:
+        cell._style = StyleArray()
+    return cell._style
+
+
+class ExportStats:
+    """
+    Wall time, call count and item count per export phase.
+
+    Phases are recorded per sheet name, workbook-wide phases (save) under
+    None. Pass an instance as stats= to export_luckysheet_to_excel; when
+    stats is None the exporter skips all timing. callback, if given, is
+    called as callback(sheet, phase, seconds, items) after every phase.
+    counts holds workbook-wide counters, such as the string cells and the
+    strings stored for them by the native engine.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.sheets = {}
+        self.counts = {}
+
+    def add(self, sheet, phase, seconds, items=1):
+        entry = self.sheets.setdefault(sheet, {}).setdefault(phase, [0.0, 0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+        entry[2] += items
+        if self.callback is not None:
+            self.callback(sheet, phase, seconds, items)
+
+    def record(self, sheet, phase, start, items=1):
+        # Returns the end time so consecutive phases can be chained
+        now = perf_counter()
+        self.add(sheet, phase, now - start, items)
+        return now
+
+    def count(self, name, amount):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def dedup_ratio(self):
+        # String cells per string written to the file, 1.0 without any sharing
+        stored = self.counts.get("shared_strings", 0) + self.counts.get("inline_strings", 0)
+        return self.counts.get("string_cells", 0) / stored if stored else 1.0
+
+    def totals(self):
+        totals = {}
+        for phases in self.sheets.values():
+            for phase, (seconds, calls, items) in phases.items():
+                entry = totals.setdefault(phase, [0.0, 0, 0])
+                entry[0] += seconds
+                entry[1] += calls
+                entry[2] += items
+        return {phase: {"seconds": seconds, "calls": calls, "items": items}
+                for phase, (seconds, calls, items) in totals.items()}
+
+
+def apply_font_styles(cell, font_info, style_cache=None):
+    key = font_style_key(font_info)
+    bg = font_info.get("bg")
+    alignment = alignment_key(font_info)
+    if style_cache is None:
+        if bg:
+            cell.fill = build_fill(bg)
+        cell.font = build_font(key)
+        if alignment is not None:
+            cell.alignment = build_alignment(alignment)
+        return
+
+    wb = cell.parent.parent
+    style = style_array(cell)
+    if bg:
+        style.fillId = style_cache.style_id(wb, "_fills", bg, build_fill)
+    style.fontId = style_cache.style_id(wb, "_fonts", key, build_font)
+    if alignment is not None:
+        style.alignmentId = style_cache.style_id(wb, "_alignments", alignment, build_alignment)
+
+
+@lru_cache(maxsize=1024)
+def number_format(fa):
+    """
+    Excel number format code for a Luckysheet ct.fa, None for General.
+
+    Luckysheet writes dates the Java way (yyyy-MM-dd HH:mm:ss); Excel tells
+    months from minutes by position, so the date letters are lowercased.
+    Quoted text, [..] sections, escaped characters and AM/PM are kept.
+    """
+    if not fa or fa == "General":
+        return None
+    parts = []
+    i = 0
+    while i < len(fa):
+        char = fa[i]
+        if char == '"':
+            end = fa.find('"', i + 1)
+            end = len(fa) if end == -1 else end + 1
+        elif char == "[":
+            end = fa.find("]", i + 1)
+            end = len(fa) if end == -1 else end + 1
+        elif char == "\\":
+            end = i + 2
+        elif fa[i:i + 5].upper() == "AM/PM":
+            end = i + 5
+        elif fa[i:i + 3].upper() == "A/P":
+            end = i + 3
+        else:
+            parts.append(char.lower() if char in "YMDHS" else char)
+            i += 1
+            continue
+        parts.append(fa[i:end])
+        i = end
+    return "".join(parts)
+
+
+def apply_number_format(cell, cell_type, style_cache=None):
+    fmt = number_format(cell_type.get("fa")) if cell_type else None
+    if fmt is None:
+        return
+    if style_cache is None:
+        cell.number_format = fmt
+        return
+
+    # Same ids as the cell.number_format setter: builtin formats first, then the workbook's own
+    fmt_id = BUILTIN_FORMATS_REVERSE.get(fmt)
+    if fmt_id is None:
+        fmt_id = BUILTIN_FORMATS_MAX_SIZE + style_cache.style_id(cell.parent.parent, "_number_formats", fmt, str)
+    style_array(cell).numFmtId = fmt_id
+
+
+def apply_border_styles(cell, border_info, style_cache=None):
+    apply_border_key(cell, border_style_key(border_info), style_cache)
+
+
+def apply_border_key(cell, key, style_cache=None):
+    if style_cache is None:
+        cell.border = build_border(key)
+        return
+
+    style_array(cell).borderId = style_cache.style_id(cell.parent.parent, "_borders", key, build_border)
+
+
+class MergeIndex:
+    """
+    Grid index over merged ranges for overlap checks.
+
+    Each range is registered in every bucket x bucket block it touches, so
+    a lookup only compares against the ranges sharing a block with it
+    instead of all of them.
+    """
+
+    def __init__(self, bucket=64):
+        self.bucket = bucket
+        self.blocks = {}
+
+    def _blocks(self, min_row, min_col, max_row, max_col):
+        for block_row in range(min_row // self.bucket, max_row // self.bucket + 1):
+            for block_col in range(min_col // self.bucket, max_col // self.bucket + 1):
+                yield block_row, block_col
+
+    def add(self, merge):
+        for block in self._blocks(*merge):
+            self.blocks.setdefault(block, []).append(merge)
+
+    def overlapping(self, merge):
+        min_row, min_col, max_row, max_col = merge
+        found = {}
+        for block in self._blocks(*merge):
+            for other in self.blocks.get(block, ()):
+                if other[0] <= max_row and min_row <= other[2] and other[1] <= max_col and min_col <= other[3]:
+                    found[other] = None
+        return list(found)
+
+    def find(self, row, col):
+        for other in self.blocks.get((row // self.bucket, col // self.bucket), ()):
+            if other[0] <= row <= other[2] and other[1] <= col <= other[3]:
+                return other
+        return None
+
+
+def range_name(merge):
+    return CellRange(min_row=merge[0], min_col=merge[1], max_row=merge[2], max_col=merge[3]).coord
+
+
+def clip_merge(merge, other):
+    # Cuts merge just above or left of other; None when other holds its top-left cell
+    min_row, min_col, max_row, max_col = merge
+    if other[0] > min_row:
+        return min_row, min_col, other[0] - 1, max_col
+    if other[1] > min_col:
+        return min_row, min_col, max_row, other[1] - 1
+    return None
+
+
+def collect_merges(sheet_data, policy="drop"):
+    """
+    Merged ranges of a sheet as (min_row, min_col, max_row, max_col), 1-based.
+
+    Ranges come from config.merge and from the "mc" markers of top-left
+    cells, in that order; single cells are not merged. A range overlapping
+    an earlier one is handled by policy (see MERGE_POLICIES), and values in
+    celldata that a range would cover are reported: "reject" raises
+    ValueError, the other policies warn and let the merge drop them.
+    """
+    sheet_name = sheet_data.get("name", "Sheet")
+    declared = {}
+    for merge_info in sheet_data.get("config", {}).get("merge", {}).values():
+        declared[(merge_info["r"], merge_info["c"])] = merge_info
+    valued = []
+    for cell_info in sheet_data.get("celldata", []):
+        cell_value = cell_info["v"]
+        if not isinstance(cell_value, dict):
+            continue
+        if cell_value.get("v") is not None:
+            valued.append(cell_info)
+        merge_info = cell_value.get("mc")
+        if merge_info and "rs" in merge_info and (merge_info["r"], merge_info["c"]) not in declared:
+            declared[(merge_info["r"], merge_info["c"])] = merge_info
+
+    candidates = [(merge_info["r"] + 1, merge_info["c"] + 1, merge_info["r"] + merge_info["rs"],
+                   merge_info["c"] + merge_info["cs"])
+                  for merge_info in declared.values() if merge_info["rs"] > 1 or merge_info["cs"] > 1]
+    if not candidates:
+        return []
+    # Blocks about twice the typical merge size keep a few ranges per block
+    sides = sorted(max(merge[2] - merge[0], merge[3] - merge[1]) + 1 for merge in candidates)
+    index = MergeIndex(max(4, 2 * sides[len(sides) // 2]))
+
+    merges = []
+    dropped = clipped = 0
+    for merge in candidates:
+        overlaps = index.overlapping(merge)
+        if overlaps and policy == "reject":
+            raise ValueError("Sheet {0}: merge {1} overlaps {2}".format(
+                sheet_name, range_name(merge), range_name(overlaps[0])))
+        end = merge[2:]
+        while overlaps and merge is not None:
+            merge = clip_merge(merge, overlaps[0]) if policy == "clip" else None
+            overlaps = index.overlapping(merge) if merge is not None else []
+        if merge is None or (merge[0], merge[1]) == (merge[2], merge[3]):
+            dropped += 1
+            continue
+        if merge[2:] != end:
+            clipped += 1
+        index.add(merge)
+        merges.append(merge)
+
+    conflicts = 0
+    for cell_info in valued:
+        row, col = cell_info["r"] + 1, cell_info["c"] + 1
+        merge = index.find(row, col)
+        if merge is not None and (row, col) != (merge[0], merge[1]):
+            if policy == "reject":
+                raise ValueError("Sheet {0}: cell {1} has a value but is covered by merge {2}".format(
+                    sheet_name, range_name((row, col, row, col)), range_name(merge)))
+            conflicts += 1
+
+    if dropped or clipped or conflicts:
+        warnings.warn("Sheet {0}: {1} overlapping merges dropped, {2} clipped, {3} covered values discarded".format(
+            sheet_name, dropped, clipped, conflicts), stacklevel=2)
+    return merges
+
+
+def drop_covered(cells, min_row, min_col, max_row, max_col):
+    # Removes the coordinates inside the range but its top-left one from a
+    # (row, col) keyed dict, walking whichever of the two is smaller
+    if (max_row - min_row + 1) * (max_col - min_col + 1) > len(cells):
+        coords = [(row, col) for row, col in cells if min_row <= row <= max_row and min_col <= col <= max_col]
+    else:
+        coords = ((row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1))
+    for coord in coords:
+        if coord != (min_row, min_col):
+            cells.pop(coord, None)
+
+
+def merge_border_edges(start_key, end_key, min_row, min_col, max_row, max_col):
+    # Border keys of the perimeter of a merged range the way openpyxl's
+    # MergedCellRange formats it: the top-left border, plus right and bottom
+    # from the bottom-right cell, drawn along the matching edges
+    left, right, top, bottom = start_key or (None, None, None, None)
+    if end_key:
+        right = right or end_key[1]
+        bottom = bottom or end_key[3]
+    edges = {}
+    if left or right or top or bottom:
+        edges[(min_row, min_col)] = (left, right, top, bottom)
+
+    def draw(coords, side, value):
+        for coord in coords:
+            if coord != (min_row, min_col):
+                key = edges.get(coord, (None, None, None, None))
+                edges[coord] = key[:side] + (value,) + key[side + 1:]
+
+    if left:
+        draw(((row, min_col) for row in range(min_row, max_row + 1)), 0, left)
+    if right:
+        draw(((row, max_col) for row in range(min_row, max_row + 1)), 1, right)
+    if top:
+        draw(((min_row, col) for col in range(min_col, max_col + 1)), 2, top)
+    if bottom:
+        draw(((max_row, col) for col in range(min_col, max_col + 1)), 3, bottom)
+    return edges
+
+
+def merge_range(ws, min_row, min_col, max_row, max_col, borders=None, style_cache=None):
+    # Same result as ws.merge_cells, but the covered cells are dropped instead
+    # of being replaced by MergedCell objects and only the perimeter cells
+    # that get a border are created
+    borders = borders or {}
+    edges = merge_border_edges(borders.get((min_row, min_col)),
+                               borders.get((max_row, max_col)) if (max_row, max_col) != (min_row, min_col) else None,
+                               min_row, min_col, max_row, max_col)
+    drop_covered(ws._cells, min_row, min_col, max_row, max_col)
+    # MultiCellRange.add checks containment against every range, which is
+    # quadratic over a sheet; collect_merges already gives distinct ranges
+    ws.merged_cells.ranges.add(CellRange(min_col=min_col, min_row=min_row, max_col=max_col, max_row=max_row))
+    ws.cell(row=min_row, column=min_col)
+    for (row, col), key in edges.items():
+        apply_border_key(ws.cell(row=row, column=col), key, style_cache)
+
+
+def sheet_title(name):
+    # Excel sheet names: 1-31 characters, none of \ / ? * [ ] :, no ' at either end
+    title = INVALID_TITLE_CHARS.sub("_", str(name)).strip("'")[:31]
+    return title or "Sheet"
+
+
+def unique_sheet_title(name, used):
+    # used: lower-cased titles already in the workbook (Excel compares them case-insensitively)
+    title = base = sheet_title(name)
+    count = 1
+    while title.lower() in used:
+        count += 1
+        suffix = " ({0})".format(count)
+        title = base[:31 - len(suffix)] + suffix
+    used.add(title.lower())
+    return title
+
+
+def sheet_reference(title):
+    if UNQUOTED_SHEET_NAME.fullmatch(title) and not CELL_REFERENCE.fullmatch(title):
+        return title + "!"
+    return "'{0}'!".format(title.replace("'", "''"))
+
+
+class SheetTitles:
+    """
+    Excel titles of the sheets of one export, by Luckysheet name.
+
+    A name gets its title (see unique_sheet_title) when its sheet is added
+    or when a formula first refers to it, whichever comes first, so a
+    reference written before a streamed sheet arrives still points at it.
+    Passing all names up front gives the titles in sheet order, and lets
+    referenced() tell references to sheets that are not in the workbook.
+    Names are compared case-insensitively, as Excel does.
+    """
+
+    def __init__(self, names=None):
+        self.used = set()
+        self.titles = {}
+        self.added = set()
+        # Lower-cased names of all sheets, None when they arrive one by one
+        self.names = None if names is None else set()
+        for name in names or ():
+            self.names.add(str(name).lower())
+            self.reference(name)
+
+    def reference(self, name):
+        key = str(name).lower()
+        title = self.titles.get(key)
+        if title is None:
+            title = self.titles[key] = unique_sheet_title(name, self.used)
+        return title
+
+    def add(self, name):
+        # Title for the next sheet; a second sheet of the same name gets a title of its own
+        key = str(name).lower()
+        if key in self.added:
+            return unique_sheet_title(name, self.used)
+        self.added.add(key)
+        return self.reference(name)
+
+    def referenced(self, sheet_data):
+        # {lower-cased name: title} of the sheets the formulas of sheet_data
+        # refer to; the title is None for a sheet that is not in the workbook
+        found = {}
+        for cell_info in sheet_data.get("celldata", []):
+            formula = cell_info["v"].get("f") if isinstance(cell_info["v"], dict) else None
+            if formula and "!" in formula:
+                for match in FORMULA_TOKENS.finditer(formula):
+                    if match.group("sheet"):
+                        name = reference_sheet_name(match.group("sheet"))
+                        key = name.lower()
+                        found[key] = self.reference(name) if self.names is None or key in self.names else None
+        return found
+
+
+def sheet_titles(data, default="Sheet"):
+    # SheetTitles of an export; sheets given as a list are named in order up
+    # front. default names a sheet without a name, formatted with its 1-based index
+    if isinstance(data, (list, tuple)):
+        return SheetTitles([sheet_data.get("name") or default.format(index)
+                            for index, sheet_data in enumerate(data, 1)])
+    return SheetTitles()
+
+
+def reference_sheet_name(sheet):
+    # Sheet name of a Sheet1! or 'My sheet'! prefix
+    return sheet[1:-2].replace("''", "'") if sheet.startswith("'") else sheet[:-1]
+
+
+def rename_sheet_refs(formula, sheet_titles=None):
+    # Cross-sheet references follow the sheets to their Excel titles, so they
+    # stay valid when a name has to be changed for Excel. sheet_titles is
+    # SheetTitles.referenced(); without it names only go through sheet_title.
+    # None for a formula referring to a sheet that is not in the workbook
+    if "!" not in formula:
+        return formula
+    missing = []
+
+    def replace(match):
+        sheet = match.group("sheet")
+        if sheet is None:
+            return match.group(0)
+        name = reference_sheet_name(sheet)
+        title = sheet_titles.get(name.lower()) if sheet_titles else None
+        if title is None:
+            if sheet_titles and name.lower() in sheet_titles:
+                missing.append(name)
+            title = sheet_title(name)
+        return sheet if title == name else sheet_reference(title)
+
+    formula = FORMULA_TOKENS.sub(replace, formula)
+    return None if missing else formula
+
+
+def formula_shape(formula, row, col):
+    # The formula with every cell reference made relative to (row, col):
+    # cells of one column with equal shapes hold the same formula filled down.
+    # None when the formula has whole-row ranges, which are not shifted here
+    parts = []
+    pos = 0
+    for match in FORMULA_TOKENS.finditer(formula):
+        kind = match.lastgroup
+        if kind == "rows":
+            return None
+        if kind == "cell":
+            col_abs, letters, row_abs, digits = match.group(4, 5, 6, 7)
+            ref_col = COLUMN_INDEX.get(letters.upper())
+            if ref_col is None:
+                return None
+            parts.append(formula[pos:match.start()])
+            parts.append("C%d" % ref_col if col_abs else "C[%d]" % (ref_col - col))
+            parts.append("R" + digits if row_abs else "R[%d]" % (int(digits) - row))
+            pos = match.end()
+    parts.append(formula[pos:])
+    return "".join(parts)
+
+
+def shared_formulas(formulas):
+    # formulas: (row, col) -> formula. Runs of two or more cells down a column
+    # with the same shape become one shared formula; returns
+    # (row, col) -> (si, ref), ref being set on the first cell of the run only
+    shared = {}
+    run = []
+    run_shape = None
+    si = 0
+
+    def close():
+        nonlocal si
+        if len(run) > 1:
+            (first_row, col), (last_row, _) = run[0], run[-1]
+            shared[run[0]] = (si, "%s%d:%s%d" % (COLUMN_LETTERS[col], first_row, COLUMN_LETTERS[col], last_row))
+            for coord in run[1:]:
+                shared[coord] = (si, None)
+            si += 1
+
+    for col, row in sorted((col, row) for row, col in formulas):
+        shape = formula_shape(formulas[(row, col)], row, col)
+        if shape is None or not run or shape != run_shape or run[-1] != (row - 1, col):
+            close()
+            run = []
+            run_shape = shape
+        if shape is not None:
+            run.append((row, col))
+    close()
+    return shared
 
 if __name__ == "__main__":
     excel_data = [{
@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+import main
+from main import BORDER_TYPE_EDGES, border_side_key, border_type_edges, resolve_borders
+
+ROWS, COLS = 12, 8
+EMPTY = (None, None, None, None)
+
+
+@pytest.fixture
+def small_sheet(monkeypatch):
+    monkeypatch.setattr(main, "MAX_ROW", ROWS)
+    monkeypatch.setattr(main, "MAX_COL", COLS)
+
+
+def reference(border_info_data):
+    # Every side applied cell by cell over the whole sheet
+    grid = {(row, col): EMPTY for row in range(1, ROWS + 1) for col in range(1, COLS + 1)}
+    for border_info in border_info_data:
+        if border_info["rangeType"] == "cell":
+            value = border_info["value"]
+            coord = (value["row_index"] + 1, value["col_index"] + 1)
+            grid[coord] = tuple(border_side_key(value[side]) if side in value else old
+                                for side, old in zip("lrtb", grid[coord]))
+            continue
+        border_type = border_info["borderType"]
+        side_key = None if border_type == "border-none" else (border_info["style"], border_info["color"])
+        for range_data in border_info["range"]:
+            for side, first_row, last_row, first_col, last_col in border_type_edges(
+                    border_type, range_data["row"], range_data["column"]):
+                for row in range(first_row + 1, last_row + 2):
+                    for col in range(first_col + 1, last_col + 2):
+                        key = grid[(row, col)]
+                        grid[(row, col)] = key[:side] + (side_key,) + key[side + 1:]
+    return grid
+
+
+def rendered(border_info_data, cell_coords=(), range_limit=5):
+    # What a cell shows: its own border, else its row's, else its column's
+    borders, column_borders, row_borders = resolve_borders(border_info_data, cell_coords, range_limit)
+    grid = {}
+    for row in range(1, ROWS + 1):
+        for col in range(1, COLS + 1):
+            key = borders.get((row, col))
+            if key is None:
+                key = row_borders[row] if row in row_borders else column_borders.get(col, EMPTY)
+            grid[(row, col)] = key
+    return grid
+
+
+def span(rnd, size):
+    # Whole-sheet spans often, so bands get exercised
+    if rnd.random() < 0.5:
+        return [0, size - 1]
+    first = rnd.randrange(size)
+    return [first, rnd.randrange(first, size)]
+
+
+def random_entry(rnd):
+    if rnd.random() < 0.15:
+        value = {"row_index": rnd.randrange(ROWS), "col_index": rnd.randrange(COLS)}
+        for side in "lrtb":
+            if rnd.random() < 0.5:
+                value[side] = None if rnd.random() < 0.3 else {"style": rnd.choice([1, 2]), "color": "#000000"}
+        return {"rangeType": "cell", "value": value}
+    return {"rangeType": "range", "borderType": rnd.choice(sorted(BORDER_TYPE_EDGES)),
+            "style": str(rnd.choice([1, 2, 8])), "color": rnd.choice(["#000000", "#ff0000"]),
+            "range": [{"row": span(rnd, ROWS), "column": span(rnd, COLS)}]}
+
+
+def test_random_entries_match_cell_by_cell(small_sheet):
+    rnd = random.Random(0)
+    for _ in range(3000):
+        entries = [random_entry(rnd) for _ in range(rnd.randrange(1, 6))]
+        assert rendered(entries) == reference(entries), entries
+
+
+def full(border_type, rows=(0, ROWS - 1), cols=(0, COLS - 1)):
+    return {"rangeType": "range", "borderType": border_type, "style": "1", "color": "#000000",
+            "range": [{"row": list(rows), "column": list(cols)}]}
+
+
+def test_row_band_clears_column_bands(small_sheet):
+    entries = [full("border-all"), full("border-none", rows=(0, 3))]
+    assert rendered(entries) == reference(entries)
+    assert rendered(entries)[(2, 3)] == EMPTY
+
+
+def test_row_band_over_column_band(small_sheet):
+    entries = [full("border-left", cols=(0, 0)), full("border-all", rows=(0, 4))]
+    assert rendered(entries) == reference(entries)
+
+
+def test_bounded_ranges_are_not_banded(small_sheet):
+    borders, column_borders, row_borders = resolve_borders([full("border-all", rows=(0, 4), cols=(0, 4))], (), 5)
+    assert not column_borders and not row_borders
+    assert len(borders) == 25
+
+
+def test_cell_coords_get_the_band(small_sheet):
+    borders, column_borders, row_borders = resolve_borders([full("border-left", cols=(1, 1))], [(3, 2), (3, 3)], 5)
+    assert column_borders == {2: (("1", "#000000"), None, None, None)}
+    assert borders == {(3, 2): column_borders[2]}
@@ -0,0 +1,108 @@
+import pytest
+
+from formula_eval import evaluate_formulas
+
+
+def cell(r, c, v=None, f=None):
+    value = {"v": v}
+    if f:
+        value["f"] = f
+    return {"r": r, "c": c, "v": value}
+
+
+def evaluate(formula, cells=(), other=()):
+    # Value of formula placed in F1 of sheet S, next to cells; other goes into sheet Other
+    data = [{"name": "S", "celldata": list(cells) + [cell(0, 5, f=formula)]},
+            {"name": "Other", "celldata": list(other)}]
+    graph = evaluate_formulas(data)
+    return graph.cells[("S", 0, 5)]["v"]
+
+
+@pytest.mark.parametrize("formula, expected", [
+    ("=1+2*3", 7),
+    ("=-2^2", 4),
+    ("=2^3^2", 64),
+    ("=50%", 0.5),
+    ("=2*3&\"x\"", "6x"),
+    ("=1+2>2", True),
+    ('="A"="a"', True),
+])
+def test_precedence(formula, expected):
+    assert evaluate(formula) == expected
+
+
+def test_errors_and_iferror():
+    assert evaluate("=1/0") == "#DIV/0!"
+    assert evaluate('=IFERROR(1/0,"x")') == "x"
+    assert evaluate("=IFERROR(#N/A,0)") == 0
+    assert evaluate("=IFERROR(2,0)") == 2
+    # An error held by a referenced cell propagates
+    assert evaluate("=A1+1", [cell(0, 0, "#DIV/0!", "=1/0")]) == "#DIV/0!"
+
+
+def test_empty_reference_is_zero():
+    data = [{"name": "S", "celldata": [cell(0, 5, 5, "=A1"), cell(1, 5, 5, "=IF(TRUE,A1)")]}]
+    graph = evaluate_formulas(data)
+    assert graph.cells[("S", 0, 5)]["v"] == 0
+    assert graph.cells[("S", 1, 5)]["v"] == 0
+    assert evaluate("=A1&\"x\"") == "x"
+
+
+def test_ranges():
+    cells = [cell(0, 0, 1), cell(1, 0, 2), cell(2, 0, 3), cell(0, 1, 4)]
+    assert evaluate("=SUM(A1:A3)", cells) == 6
+    assert evaluate("=SUM(A3:A1)", cells) == 6
+    assert evaluate("=AVERAGE(A1:A3,B1)", cells) == 2.5
+    assert evaluate("=COUNT(A1:B3)", cells) == 4
+    assert evaluate("=MAX(A1:A3)-MIN(A1:A3)", cells) == 2
+
+
+def test_other_sheets():
+    other = [cell(0, 0, 10), cell(1, 0, 20)]
+    assert evaluate("=Other!A1*2", other=other) == 20
+    assert evaluate("=SUM('Other'!A1:A2)", other=other) == 30
+    assert evaluate("=other!A1", other=other) == 10
+    assert evaluate("=Missing!A1") == "#REF!"
+    assert evaluate("=SUM(Missing!A1:B2)") == "#REF!"
+    assert evaluate("=IFERROR(Missing!A1,-1)") == -1
+
+
+def test_unsupported_keeps_value():
+    data = [{"name": "S", "celldata": [cell(0, 0, 5, "=FOO(1)")]}]
+    graph = evaluate_formulas(data)
+    assert graph.unsupported == 1
+    assert data[0]["celldata"][0]["v"]["v"] == 5
+
+
+def test_cycles_keep_their_values():
+    # Formulas on a cycle and those depending on one are not evaluated
+    data = [{"name": "S", "celldata": [cell(0, 0, 7, "=A2"), cell(1, 0, 8, "=A1"), cell(2, 0, 3, "=A1+A2"),
+                                       cell(3, 0, 1), cell(4, 0, f="=A4+1")]}]
+    graph = evaluate_formulas(data)
+    assert graph.cycles == {("S", 0, 0), ("S", 1, 0), ("S", 2, 0)}
+    assert [graph.cells[("S", r, 0)]["v"] for r in range(3)] == [7, 8, 3]
+    assert graph.cells[("S", 4, 0)]["v"] == 2
+
+
+def test_filled_down_formulas():
+    cells = [cell(r, 0, r + 1) for r in range(4)] + [cell(r, 1, f="=A{0}*2".format(r + 1)) for r in range(4)]
+    graph = evaluate_formulas([{"name": "S", "celldata": cells}])
+    assert [graph.cells[("S", r, 1)]["v"] for r in range(4)] == [2, 4, 6, 8]
+
+
+def test_set_values_reevaluates_dependents_only():
+    cells = ([cell(r, 0, r) for r in range(5)] + [cell(r, 1, f="=A{0}*2".format(r + 1)) for r in range(5)]
+             + [cell(0, 2, f="=SUM(B1:B5)"), cell(1, 2, f="=C1+1"), cell(2, 2, f="=A1")])
+    data = [{"name": "S", "celldata": cells}]
+    graph = evaluate_formulas(data)
+    assert graph.cells[("S", 1, 2)]["v"] == 21
+
+    changed = graph.set_values({("S", 4, 0): 100})
+    assert set(changed) == {("S", 4, 1), ("S", 0, 2), ("S", 1, 2)}
+    assert graph.cells[("S", 4, 1)]["v"] == 200
+    assert graph.cells[("S", 1, 2)]["v"] == 213
+
+    # A new cell inside a range a formula reads
+    assert graph.set_values({("S", 9, 9): 1}) == []
+    with pytest.raises(ValueError):
+        graph.set_values({("S", 0, 1): 1})
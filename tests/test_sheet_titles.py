@@ -0,0 +1,35 @@
+from main import rename_sheet_refs, sheet_titles
+from xlsx_writer import collect_cells
+
+
+def cell(r, c, v=None, f=None):
+    value = {"v": v}
+    if f:
+        value["f"] = f
+    return {"r": r, "c": c, "v": value}
+
+
+def test_titles_follow_renamed_sheets():
+    data = [{"name": "a/b"}, {"name": "Use"}]
+    titles = sheet_titles(data)
+    referenced = titles.referenced({"celldata": [cell(0, 0, f="='a/b'!A1+use!A1")]})
+    assert referenced == {"a/b": "a_b", "use": "Use"}
+    assert rename_sheet_refs("='a/b'!A1+use!A1", referenced) == "=a_b!A1+Use!A1"
+
+
+def test_missing_sheets_keep_the_value():
+    data = [{"name": "S", "celldata": [cell(0, 0, 7, "=Gone!A1+S!A2"), cell(1, 0, 3, "=S!A3")]}]
+    titles = sheet_titles(data)
+    referenced = titles.referenced(data[0])
+    assert referenced == {"gone": None, "s": "S"}
+    assert rename_sheet_refs("=Gone!A1+S!A2", referenced) is None
+
+    cells, _, _, _ = collect_cells(data[0], formula_titles=referenced)
+    assert cells.values == [7, 3]
+    assert cells.formulas == {1: "=S!A3"}
+
+
+def test_streamed_sheets_are_not_checked():
+    # A name that is not known yet may be a sheet that comes later
+    titles = sheet_titles(iter([{"name": "S"}]))
+    assert titles.referenced({"celldata": [cell(0, 0, f="=Later!A1")]}) == {"later": "Later"}
@@ -0,0 +1,698 @@
+import hashlib
+import pickle
+import re
+import sys
+import zipfile
+from array import array
+from time import perf_counter
+from collections import deque
+from functools import lru_cache
+from io import BytesIO
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
+from xml.sax.saxutils import escape, quoteattr
+
+from openpyxl.styles.numbers import BUILTIN_FORMATS_MAX_SIZE, BUILTIN_FORMATS_REVERSE
+
+from export_cache import SizeBoundedLRU
+from main import (BORDER_RANGE_LIMIT, COLUMN_LETTERS, ExportStats, MergeIndex, alignment_key, alignment_values,
+                  collect_merges, column_spans, drop_covered, font_style_key, map_border_style, merge_border_edges,
+                  number_format, rename_sheet_refs, resolve_borders, rgb_string_to_hex, rich_text_runs,
+                  shared_formulas, sheet_titles)
+
+
+CONTENT_TYPES = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">\
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>\
+<Default Extension="xml" ContentType="application/xml"/>\
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>\
+{sheets}\
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>\
+<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>\
+</Types>'''
+
+SHEET_CONTENT_TYPE = ('<Override PartName="/xl/worksheets/sheet{0}.xml" ContentType="application/'
+                      'vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+
+ROOT_RELS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">\
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" \
+Target="xl/workbook.xml"/>\
+</Relationships>'''
+
+WORKBOOK_RELS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">\
+{sheets}\
+<Relationship Id="rId{styles}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" \
+Target="styles.xml"/>\
+<Relationship Id="rId{strings}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" \
+Target="sharedStrings.xml"/>\
+</Relationships>'''
+
+SHEET_REL = ('<Relationship Id="rId{0}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+             'worksheet" Target="worksheets/sheet{0}.xml"/>')
+
+WORKBOOK = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" \
+xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">\
+<sheets>{sheets}</sheets>\
+</workbook>'''
+
+SHEET_HEADER = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">')
+
+BORDER_SIDES = ("left", "right", "top", "bottom")
+
+# Distinct strings per string cell above which a sheet writes inline strings
+INLINE_STRING_RATIO = 0.9
+
+# Cached results of a formula that are written as errors (t="e") rather than text
+ERROR_VALUES = {"#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#N/A", "#GETTING_DATA"}
+
+# (font, fill, border, ct.fa, alignment) of a cell without any style
+UNSTYLED = (None, None, None, None, None)
+
+# Style and shared string ids in a rendered part; column and row styles are
+# always written right after min/max and r
+CELL_IDS = re.compile(r'<c r="[A-Z]+[0-9]+"(?: s="([0-9]+)")?(?: t="s"><v>([0-9]+)</v>)?'
+                      r'|(?:<col min="[0-9]+" max="[0-9]+" style="|<row r="[0-9]+" s=")([0-9]+)')
+
+
+def color_xml(tag, color):
+    return '<{0} rgb="00{1}"/>'.format(tag, rgb_string_to_hex(color))
+
+
+def font_xml(key):
+    size, bold, italic, underline, strike, color, name = key
+    parts = ["<font>"]
+    if name:
+        parts.append("<name val=%s/>" % quoteattr(name))
+    if bold:
+        parts.append("<b/>")
+    if italic:
+        parts.append("<i/>")
+    if strike:
+        parts.append("<strike/>")
+    if underline:
+        parts.append('<u val="%s"/>' % underline)
+    if color:
+        # Already hex in the normalized key
+        parts.append('<color rgb="00%s"/>' % color)
+    if size:
+        parts.append('<sz val="%s"/>' % size)
+    parts.append("</font>")
+    return "".join(parts)
+
+
+@lru_cache(maxsize=1024)
+def run_properties_xml(key):
+    # <rPr> of a rich text run: a <font> with rFont for name, rendered once per font
+    return font_xml(key).replace("<font>", "<rPr>", 1).replace("<name ", "<rFont ", 1).replace("</font>", "</rPr>")
+
+
+def text_xml(value):
+    # <t> of a string, or the <r> runs of rich text given as ((font_key, text), ...)
+    if isinstance(value, tuple):
+        return "".join("<r>%s%s</r>" % (run_properties_xml(key), text_xml(text)) for key, text in value)
+    space = ' xml:space="preserve"' if value != value.strip() else ''
+    return "<t%s>%s</t>" % (space, escape(value))
+
+
+def alignment_xml(key):
+    horizontal, vertical, wrap_text, text_rotation = alignment_values(key)
+    attrs = "".join([' horizontal="%s"' % horizontal if horizontal else '',
+                     ' vertical="%s"' % vertical if vertical else '',
+                     ' textRotation="%d"' % text_rotation if text_rotation else '',
+                     ' wrapText="1"' if wrap_text else ''])
+    return '<alignment%s/>' % attrs if attrs else ''
+
+
+def fill_xml(bg):
+    return ('<fill><patternFill patternType="solid">%s<bgColor rgb="00000000"/></patternFill></fill>'
+            % color_xml("fgColor", bg))
+
+
+def border_xml(key):
+    if not any(key):
+        return "<border><left/><right/><top/><bottom/><diagonal/></border>"
+    parts = ["<border>"]
+    for name, side in zip(BORDER_SIDES, key):
+        if side:
+            parts.append('<{0} style="{1}">{2}</{0}>'.format(name, map_border_style(side[0]),
+                                                               color_xml("color", side[1])))
+    parts.append("</border>")
+    return "".join(parts)
+
+
+class StylesTable:
+    """
+    Precompiled styles.xml for the native writer.
+
+    Every distinct (font, fill, border, ct.fa) key combination is assigned a
+    cellXfs index the first time it is seen, and its XML fragments are
+    rendered once; cells only do a dict lookup. Keys that render to the
+    same XML share one entry.
+    """
+
+    def __init__(self):
+        self.fonts = {}
+        self.fills = {}
+        self.borders = {}
+        self.xfs = {UNSTYLED: 0}
+        # ct.fa -> numFmtId, and the custom formats as formatCode -> numFmtId
+        self.num_fmts = {}
+        self.num_fmt_parts = {}
+        # rendered xml -> index, in document order
+        self.font_parts = {'<font><name val="Calibri"/><family val="2"/><sz val="11"/></font>': 0}
+        self.fill_parts = {'<fill><patternFill/></fill>': 0,
+                           '<fill><patternFill patternType="gray125"/></fill>': 1}
+        self.border_parts = {border_xml((None, None, None, None)): 0}
+        self.xf_parts = {'<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>': 0}
+
+    def _index(self, table, parts, key, render):
+        if key is None:
+            return 0
+        index = table.get(key)
+        if index is None:
+            index = table[key] = parts.setdefault(render(key), len(parts))
+        return index
+
+    def num_fmt_id(self, fa):
+        num_fmt_id = self.num_fmts.get(fa)
+        if num_fmt_id is None:
+            fmt = number_format(fa)
+            if fmt is None:
+                num_fmt_id = 0
+            elif fmt in BUILTIN_FORMATS_REVERSE:
+                num_fmt_id = BUILTIN_FORMATS_REVERSE[fmt]
+            else:
+                num_fmt_id = self.num_fmt_parts.setdefault(fmt, BUILTIN_FORMATS_MAX_SIZE + len(self.num_fmt_parts))
+            self.num_fmts[fa] = num_fmt_id
+        return num_fmt_id
+
+    def xf_id(self, font_key, fill_key, border_key, fa=None, alignment=None):
+        key = (font_key, fill_key, border_key, fa, alignment)
+        xf_id = self.xfs.get(key)
+        if xf_id is not None:
+            return xf_id
+
+        font_id = self._index(self.fonts, self.font_parts, font_key, font_xml)
+        fill_id = self._index(self.fills, self.fill_parts, fill_key, fill_xml)
+        border_id = self._index(self.borders, self.border_parts, border_key, border_xml)
+        num_fmt_id = self.num_fmt_id(fa) if fa else 0
+        alignment = alignment_xml(alignment) if alignment is not None else ''
+        xf = '<xf numFmtId="%d" fontId="%d" fillId="%d" borderId="%d" xfId="0"%s%s%s%s%s' % (
+            num_fmt_id, font_id, fill_id, border_id,
+            ' applyNumberFormat="1"' if num_fmt_id else '',
+            ' applyFont="1"' if font_id else '',
+            ' applyFill="1"' if fill_id else '',
+            ' applyBorder="1"' if border_id else '',
+            ' applyAlignment="1">%s</xf>' % alignment if alignment else '/>')
+        xf_id = self.xfs[key] = self.xf_parts.setdefault(xf, len(self.xf_parts))
+        return xf_id
+
+    def to_xml(self):
+        num_fmts = "".join('<numFmt numFmtId="%d" formatCode=%s/>' % (num_fmt_id, quoteattr(fmt))
+                           for fmt, num_fmt_id in self.num_fmt_parts.items())
+        return "".join([
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n',
+            '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">',
+            '<numFmts count="%d">%s</numFmts>' % (len(self.num_fmt_parts), num_fmts) if num_fmts else '',
+            '<fonts count="%d">' % len(self.font_parts), "".join(self.font_parts), '</fonts>',
+            '<fills count="%d">' % len(self.fill_parts), "".join(self.fill_parts), '</fills>',
+            '<borders count="%d">' % len(self.border_parts), "".join(self.border_parts), '</borders>',
+            '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>',
+            '<cellXfs count="%d">' % len(self.xf_parts), "".join(self.xf_parts), '</cellXfs>',
+            '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>',
+            '</styleSheet>',
+        ])
+
+
+class SharedStrings:
+    """
+    Workbook-wide shared strings table (xl/sharedStrings.xml).
+
+    add() interns a value with a single dict lookup and returns its index.
+    count is the number of cells referring to the table, inline the number
+    of string cells that sheets wrote as inline strings instead.
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.count = 0
+        self.inline = 0
+
+    def add(self, value):
+        self.count += 1
+        index = self.index.get(value)
+        if index is None:
+            index = self.index[value] = len(self.index)
+        return index
+
+    def to_xml(self):
+        parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n',
+                 '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" count="%d" uniqueCount="%d">'
+                 % (self.count, len(self.index))]
+        for value in self.index:
+            parts.append("<si>%s</si>" % text_xml(value))
+        parts.append("</sst>")
+        return "".join(parts)
+
+
+class CellTable:
+    """
+    Cells of a sheet as parallel arrays, filled by collect_cells.
+
+    rows, cols and style_ids are typed arrays and values a plain list, so a
+    cell costs a few tens of bytes instead of a dict entry and a list of
+    its own. style_ids index style_keys, the distinct (font, fill, border,
+    ct.fa, alignment) keys of the sheet, id 0 being the unstyled cell.
+    Formulas are rare and kept by cell index.
+    """
+
+    def __init__(self):
+        self.rows = array("i")
+        self.cols = array("i")
+        self.style_ids = array("i")
+        self.values = []
+        self.style_keys = [UNSTYLED]
+        self.style_index = {UNSTYLED: 0}
+        self.formulas = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, row, col, value, style_key, formula=None):
+        style_id = self.style_index.get(style_key)
+        if style_id is None:
+            style_id = self.style_index[style_key] = len(self.style_keys)
+            self.style_keys.append(style_key)
+        if formula is not None:
+            self.formulas[len(self.values)] = formula
+        self.rows.append(row)
+        self.cols.append(col)
+        self.style_ids.append(style_id)
+        self.values.append(value)
+
+    def sorted_order(self):
+        # Cell indexes in row-major order; of a cell given twice the last one is kept
+        rows, cols = self.rows, self.cols
+        order = sorted(range(len(rows)), key=lambda index: rows[index] << 15 | cols[index])
+        kept = array("i")
+        for position, index in enumerate(order[:-1]):
+            following = order[position + 1]
+            if rows[index] != rows[following] or cols[index] != cols[following]:
+                kept.append(index)
+        kept.extend(order[-1:])
+        return kept
+
+
+def collect_cells(sheet_data, border_range_limit=BORDER_RANGE_LIMIT, merge_policy="drop", formula_titles=None):
+    # CellTable in the same order of application as write_sheet, plus the
+    # column and row borders from resolve_borders. formula_titles is
+    # SheetTitles.referenced() of the sheet
+    config_data = sheet_data.get("config", {})
+    cell_data = sheet_data.get("celldata", [])
+
+    borders, column_borders, row_borders = resolve_borders(
+        config_data.get("borderInfo", []), ((cell_info["r"] + 1, cell_info["c"] + 1) for cell_info in cell_data),
+        border_range_limit)
+    # Covered cells are dropped; the perimeter gets the borders of merge_border_edges
+    merges = collect_merges(sheet_data, merge_policy)
+    index = MergeIndex() if merges else None
+    for merge in merges:
+        min_row, min_col, max_row, max_col = merge
+        index.add(merge)
+        edges = merge_border_edges(borders.get((min_row, min_col)),
+                                   borders.get((max_row, max_col)) if merge[:2] != merge[2:] else None,
+                                   min_row, min_col, max_row, max_col)
+        drop_covered(borders, min_row, min_col, max_row, max_col)
+        borders.update(edges)
+
+    cells = CellTable()
+    for cell_info in cell_data:
+        row, col = cell_info["r"] + 1, cell_info["c"] + 1
+        if index is not None:
+            merge = index.find(row, col)
+            if merge is not None and (merge[0] != row or merge[1] != col):
+                continue
+        font_info = cell_info["v"]
+        value = font_info.get("v")
+        formula = font_info.get("f")
+        fa = None
+        cell_type = font_info.get("ct")
+        if cell_type:
+            fa = cell_type.get("fa")
+            runs = rich_text_runs(cell_type)
+            if runs and not formula:
+                value = tuple(runs)
+        cells.append(row, col, value, (font_style_key(font_info), font_info.get("bg") or None,
+                                       borders.get((row, col)), fa, alignment_key(font_info)),
+                     rename_sheet_refs(formula, formula_titles) if formula else None)
+
+    # Cells that only have a border
+    if borders:
+        for coord in zip(cells.rows, cells.cols):
+            borders.pop(coord, None)
+        for (row, col), key in borders.items():
+            cells.append(row, col, None, (None, None, key, None, None))
+    return cells, merges, column_borders, row_borders
+
+
+def formula_xml(formula, shared=None):
+    # shared: (si, ref) from shared_formulas, ref only on the first cell of the range
+    if shared is None:
+        return '<f>%s</f>' % escape(formula[1:])
+    si, ref = shared
+    if ref is None:
+        return '<f t="shared" si="%d"/>' % si
+    return '<f t="shared" ref="%s" si="%d">%s</f>' % (ref, si, escape(formula[1:]))
+
+
+def cell_xml(ref, value, xf_id, shared_strings, formula=None, shared=None):
+    # shared_strings is None on sheets writing inline strings
+    style = ' s="%d"' % xf_id if xf_id else ''
+    if formula is not None:
+        # The Luckysheet v is written as the cached result of the formula
+        f = formula_xml(formula, shared)
+        if value is None:
+            return '<c r="%s"%s>%s</c>' % (ref, style, f)
+        if isinstance(value, bool):
+            return '<c r="%s"%s t="b">%s<v>%d</v></c>' % (ref, style, f, value)
+        if isinstance(value, (int, float)):
+            return '<c r="%s"%s>%s<v>%r</v></c>' % (ref, style, f, value)
+        value = str(value)
+        return '<c r="%s"%s t="%s">%s<v>%s</v></c>' % (ref, style, "e" if value in ERROR_VALUES else "str", f,
+                                                       escape(value))
+    if value is None:
+        return '<c r="%s"%s/>' % (ref, style)
+    if isinstance(value, bool):
+        return '<c r="%s"%s t="b"><v>%d</v></c>' % (ref, style, value)
+    if isinstance(value, (int, float)):
+        return '<c r="%s"%s><v>%r</v></c>' % (ref, style, value)
+    if not isinstance(value, tuple):
+        value = str(value)
+        if value.startswith("=") and len(value) > 1:
+            return '<c r="%s"%s><f>%s</f><v></v></c>' % (ref, style, escape(value[1:]))
+    # Plain strings and rich text runs alike
+    if shared_strings is None:
+        return '<c r="%s"%s t="inlineStr"><is>%s</is></c>' % (ref, style, text_xml(value))
+    return '<c r="%s"%s t="s"><v>%d</v></c>' % (ref, style, shared_strings.add(value))
+
+
+def iter_sheet_xml(sheet_data, styles, shared_strings, stats=None, border_range_limit=BORDER_RANGE_LIMIT,
+                   merge_policy="drop", formula_titles=None):
+    sheet_name = sheet_data.get("name", "Sheet")
+    config_data = sheet_data.get("config", {})
+    column_len_data = config_data.get("columnlen", {})
+    row_len_data = config_data.get("rowlen", {})
+    start = perf_counter() if stats is not None else None
+    cells, merges, column_borders, row_borders = collect_cells(sheet_data, border_range_limit, merge_policy,
+                                                               formula_titles)
+    # Formulas filled down a column are written once as a shared formula
+    shared = shared_formulas({(cells.rows[index], cells.cols[index]): formula
+                              for index, formula in cells.formulas.items()})
+    # A sheet of mostly distinct strings gains nothing from the shared table,
+    # its strings are written inline
+    strings = [value for index, value in enumerate(cells.values) if index not in cells.formulas and (
+               type(value) is tuple or type(value) is str and not (value.startswith("=") and len(value) > 1))]
+    sheet_strings = shared_strings
+    if strings and len(set(strings)) > INLINE_STRING_RATIO * len(strings):
+        sheet_strings = None
+        shared_strings.inline += len(strings)
+    del strings
+    if stats is not None:
+        start = stats.record(sheet_name, "collect", start, len(cells))
+
+    yield SHEET_HEADER
+    widths = {int(col_index) + 1: col_width / 10 for col_index, col_width in column_len_data.items()}
+    spans = column_spans(widths, column_borders)
+    if spans:
+        yield "<cols>"
+        for min_col, max_col, width, key in spans:
+            parts = ['<col min="%d" max="%d"' % (min_col, max_col)]
+            if key is not None:
+                parts.append(' style="%d"' % styles.xf_id(None, None, key))
+            if width is not None:
+                parts.append(' width="%s" customWidth="1"' % width)
+            parts.append('/>')
+            yield "".join(parts)
+        yield "</cols>"
+
+    heights = {int(row_index) + 1: row_height for row_index, row_height in row_len_data.items()}
+    order = cells.sorted_order()
+    rows, cols, values, style_ids, formulas = cells.rows, cells.cols, cells.values, cells.style_ids, cells.formulas
+    # row -> (start, stop) in order
+    spans = {}
+    first = 0
+    for position in range(1, len(order) + 1):
+        if position == len(order) or rows[order[position]] != rows[order[first]]:
+            spans[rows[order[first]]] = (first, position)
+            first = position
+    xf_ids = [styles.xf_id(*style_key) for style_key in cells.style_keys]
+
+    yield "<sheetData>"
+    for row in sorted(spans.keys() | heights.keys() | row_borders.keys()):
+        parts = ['<row r="%d"' % row]
+        if row in row_borders:
+            parts.append(' s="%d" customFormat="1"' % styles.xf_id(None, None, row_borders[row]))
+        if row in heights:
+            parts.append(' ht="%s" customHeight="1"' % heights[row])
+        parts.append('>')
+        first, stop = spans.get(row, (0, 0))
+        for index in order[first:stop]:
+            value = values[index]
+            style_id = style_ids[index]
+            formula = formulas.get(index)
+            if value is None and style_id == 0 and formula is None:
+                continue
+            col = cols[index]
+            parts.append(cell_xml(COLUMN_LETTERS[col] + str(row), value, xf_ids[style_id], sheet_strings, formula,
+                                  shared.get((row, col)) if formula is not None else None))
+        parts.append("</row>")
+        yield "".join(parts)
+    yield "</sheetData>"
+
+    if merges:
+        yield '<mergeCells count="%d">' % len(merges)
+        for min_row, min_col, max_row, max_col in merges:
+            yield '<mergeCell ref="%s%d:%s%d"/>' % (COLUMN_LETTERS[min_col], min_row, COLUMN_LETTERS[max_col], max_row)
+        yield "</mergeCells>"
+    yield "</worksheet>"
+    if stats is not None:
+        # Includes the time the consumer spends compressing the yielded chunks
+        stats.record(sheet_name, "render", start)
+
+
+def render_sheet_part(sheet_data, timed=False, border_range_limit=BORDER_RANGE_LIMIT, merge_policy="drop",
+                      formula_titles=None):
+    # Runs in a worker process: the part is rendered against local style and
+    # string tables, and split around their ids so write_xlsx can fill in
+    # the workbook-wide ones with a join
+    styles = StylesTable()
+    shared_strings = SharedStrings()
+    stats = ExportStats() if timed else None
+    xml = "".join(iter_sheet_xml(sheet_data, styles, shared_strings, stats, border_range_limit, merge_policy,
+                                 formula_titles))
+    xf_keys = [None] * len(styles.xf_parts)
+    for key, xf_id in styles.xfs.items():
+        xf_keys[xf_id] = key
+    start = perf_counter() if timed else None
+    chunks, slots = split_sheet_part(xml, len(xf_keys))
+    if timed:
+        stats.record(sheet_data.get("name", "Sheet"), "split", start, len(slots))
+    phases = stats.sheets.get(sheet_data.get("name", "Sheet"), {}) if timed else {}
+    return chunks, slots, xf_keys, list(shared_strings.index), shared_strings.count, shared_strings.inline, phases
+
+
+def split_sheet_part(xml, xf_count):
+    # (chunks, slots): the part cut around its style and shared string ids,
+    # slots[i] being the id between chunks[i] and chunks[i + 1]; string ids
+    # follow the xf_count style ids
+    chunks = []
+    slots = array("i")
+    end = 0
+    for match in CELL_IDS.finditer(xml):
+        for group, offset in ((1, 0), (2, xf_count), (3, 0)):
+            start = match.start(group)
+            if start >= 0:
+                chunks.append(xml[end:start])
+                slots.append(int(match.group(group)) + offset)
+                end = match.end(group)
+    chunks.append(xml[end:])
+    return chunks, slots
+
+
+def fill_sheet_part(chunks, slots, xf_map, string_map):
+    # The part's XML with the workbook ids of its styles and strings
+    ids = [str(xf_id) for xf_id in xf_map]
+    ids.extend(str(string_id) for string_id in string_map)
+    filled = [None] * (2 * len(chunks) - 1)
+    filled[::2] = chunks
+    filled[1::2] = map(ids.__getitem__, slots)
+    return "".join(filled)
+
+
+class SheetPartCache(SizeBoundedLRU):
+    """
+    In-memory cache of rendered sheet parts for repeated native exports.
+
+    Parts are keyed by a hash of the sheet's celldata and config and are
+    kept before being mapped onto a workbook's style and string tables, cut
+    around their ids (split_sheet_part), so an unchanged sheet is reused by
+    any later export with a join. Least recently used parts are dropped once
+    the cached XML exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes=256 << 20):
+        super().__init__(max_bytes)
+        self.parts = {}
+
+    def get(self, key):
+        part = self.parts.get(key)
+        if part is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return part
+
+    def put(self, key, part):
+        self.parts[key] = part
+        self._use(key, part_size(part))
+        self._evict()
+
+    def _discard(self, key):
+        del self.parts[key]
+
+
+def part_size(part):
+    chunks, slots, xf_keys, strings, string_count, inline_count = part
+    return sum(map(sys.getsizeof, chunks)) + slots.itemsize * len(slots) + sum(len(value) for value in strings)
+
+
+def sheet_part_key(sheet_data, border_range_limit=BORDER_RANGE_LIMIT, merge_policy="drop", formula_titles=None):
+    # The sheet name only goes into workbook.xml, renaming a sheet keeps its part
+    # unless the formulas of the part refer to it.
+    # pickle is several times faster than a canonical JSON dump; equal pickles
+    # always mean equal input, while a different key order only costs a
+    # re-render. Without the memo (fast) shared objects are written out each
+    # time, which is quicker for JSON data and makes sharing irrelevant
+    payload = BytesIO()
+    pickler = pickle.Pickler(payload, protocol=4)
+    pickler.fast = True
+    pickler.dump([sheet_data.get("celldata", []), sheet_data.get("config", {}), border_range_limit, merge_policy,
+                  sorted((formula_titles or {}).items())])
+    return hashlib.sha256(payload.getbuffer()).hexdigest()
+
+
+def completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def iter_rendered_parts(sheets, styles, shared_strings, max_workers=None, stats=None, part_cache=None,
+                        border_range_limit=BORDER_RANGE_LIMIT, merge_policy="drop"):
+    # Sheets are rendered as self-contained parts, in worker processes when
+    # max_workers > 1. Keeps at most 2 * max_workers sheets in flight so a
+    # streamed input is not read ahead completely
+    parallel = max_workers and max_workers > 1
+    window = 2 * max_workers if parallel else 1
+    with ProcessPoolExecutor(max_workers=max_workers) if parallel else nullcontext() as executor:
+        pending = deque()
+        for sheet_data, title, formula_titles in sheets:
+            name = sheet_data.get("name")
+            key = part = None
+            if part_cache is not None:
+                start = perf_counter() if stats is not None else None
+                key = sheet_part_key(sheet_data, border_range_limit, merge_policy, formula_titles)
+                part = part_cache.get(key)
+                if stats is not None:
+                    stats.record(name or "Sheet", "hash", start, int(part is not None))
+            if part is not None:
+                # Nothing to store again and no render phases to report
+                pending.append((name, title, None, completed(part + ({},))))
+            elif parallel:
+                pending.append((name, title, key, executor.submit(render_sheet_part, sheet_data, stats is not None,
+                                                                  border_range_limit, merge_policy, formula_titles)))
+            else:
+                pending.append((name, title, key, completed(render_sheet_part(
+                    sheet_data, stats is not None, border_range_limit, merge_policy, formula_titles))))
+            if len(pending) >= window:
+                yield merge_sheet_part(pending.popleft(), styles, shared_strings, stats, part_cache)
+        while pending:
+            yield merge_sheet_part(pending.popleft(), styles, shared_strings, stats, part_cache)
+
+
+def merge_sheet_part(pending_part, styles, shared_strings, stats=None, part_cache=None):
+    name, title, key, future = pending_part
+    chunks, slots, xf_keys, strings, string_count, inline_count, phases = future.result()
+    if key is not None:
+        part_cache.put(key, (chunks, slots, xf_keys, strings, string_count, inline_count))
+    start = perf_counter() if stats is not None else None
+    xf_map = [styles.xf_id(*xf_key) for xf_key in xf_keys]
+    string_map = [shared_strings.add(value) for value in strings]
+    shared_strings.count += string_count - len(strings)
+    shared_strings.inline += inline_count
+    xml = fill_sheet_part(chunks, slots, xf_map, string_map)
+    if stats is not None:
+        for phase, (seconds, calls, items) in phases.items():
+            stats.add(name or "Sheet", phase, seconds, items)
+        stats.record(name or "Sheet", "merge", start, len(xf_keys) + len(strings))
+    return title, [xml]
+
+
+def iter_serial_parts(sheets, styles, shared_strings, stats=None, border_range_limit=BORDER_RANGE_LIMIT,
+                      merge_policy="drop"):
+    for sheet_data, title, formula_titles in sheets:
+        yield title, iter_sheet_xml(sheet_data, styles, shared_strings, stats, border_range_limit, merge_policy,
+                                    formula_titles)
+
+
+def iter_titled_sheets(data):
+    # (sheet_data, title, SheetTitles.referenced()) in sheet order, titles
+    # being assigned before any later sheet is read
+    titles = sheet_titles(data, "Sheet{0}")
+    for index, sheet_data in enumerate(data, 1):
+        yield sheet_data, titles.add(sheet_data.get("name") or "Sheet{0}".format(index)), titles.referenced(sheet_data)
+
+
+def write_xlsx(data, output_file, max_workers=None, stats=None, part_cache=None, border_range_limit=BORDER_RANGE_LIMIT,
+               merge_policy="drop"):
+    styles = StylesTable()
+    shared_strings = SharedStrings()
+    names = []
+
+    sheets = iter_titled_sheets(data)
+    if part_cache is not None or (max_workers and max_workers > 1):
+        parts = iter_rendered_parts(sheets, styles, shared_strings, max_workers, stats, part_cache,
+                                    border_range_limit, merge_policy)
+    else:
+        parts = iter_serial_parts(sheets, styles, shared_strings, stats, border_range_limit, merge_policy)
+
+    with zipfile.ZipFile(output_file, "w", zipfile.ZIP_DEFLATED) as zf:
+        for index, (title, chunks) in enumerate(parts, 1):
+            names.append(title)
+            with zf.open("xl/worksheets/sheet%d.xml" % index, "w") as part:
+                for chunk in chunks:
+                    part.write(chunk.encode("utf-8"))
+
+        start = perf_counter() if stats is not None else None
+        sheet_ids = range(1, len(names) + 1)
+        zf.writestr("[Content_Types].xml", CONTENT_TYPES.format(
+            sheets="".join(SHEET_CONTENT_TYPE.format(i) for i in sheet_ids)))
+        zf.writestr("_rels/.rels", ROOT_RELS)
+        zf.writestr("xl/_rels/workbook.xml.rels", WORKBOOK_RELS.format(
+            sheets="".join(SHEET_REL.format(i) for i in sheet_ids),
+            styles=len(names) + 1, strings=len(names) + 2))
+        zf.writestr("xl/workbook.xml", WORKBOOK.format(sheets="".join(
+            '<sheet name=%s sheetId="%d" r:id="rId%d"/>' % (quoteattr(name), i, i)
+            for i, name in zip(sheet_ids, names))))
+        zf.writestr("xl/styles.xml", styles.to_xml())
+        zf.writestr("xl/sharedStrings.xml", shared_strings.to_xml())
+    if stats is not None:
+        stats.record(None, "save", start)
+        stats.count("string_cells", shared_strings.count + shared_strings.inline)
+        stats.count("shared_strings", len(shared_strings.index))
+        stats.count("inline_strings", shared_strings.inline)